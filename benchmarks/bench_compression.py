@@ -0,0 +1,88 @@
+'''Throughput and file size of ncfile.save for different formats and compression.
+
+Creates synthetic file with smooth field plus noise (similar to model output)
+and saves it with every format/compression setting.
+
+Usage::
+
+    python benchmarks/bench_compression.py --shape 100 180 360
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from netCDF4 import Dataset
+
+import fixnc as fnc
+
+# (format, compression) pairs to test
+SETTINGS = [
+    ('NETCDF3_64BIT_OFFSET', None),
+    ('NETCDF4', 'none'),
+    ('NETCDF4_CLASSIC', 'fast'),
+    ('NETCDF4_CLASSIC', 'archive'),
+    ('NETCDF4_CLASSIC', {'zlib': True, 'complevel': 1, 'shuffle': False}),
+    ('NETCDF4_CLASSIC', {'zlib': True, 'complevel': 4, 'shuffle': True}),
+    ('NETCDF4_CLASSIC', {'zlib': True, 'complevel': 9, 'shuffle': True}),
+]
+
+
+def create_source(fname, shape, seed=0):
+    '''Create uncompressed file with one (time, lat, lon) float32 variable.'''
+    rng = np.random.RandomState(seed)
+    ntime, nlat, nlon = shape
+    lat = np.linspace(-np.pi / 2, np.pi / 2, nlat)[:, None]
+    lon = np.linspace(0, 2 * np.pi, nlon)[None, :]
+    fl = Dataset(fname, 'w', format='NETCDF4')
+    fl.createDimension('time', None)
+    fl.createDimension('lat', nlat)
+    fl.createDimension('lon', nlon)
+    var = fl.createVariable('temp', 'f4', ('time', 'lat', 'lon'))
+    for i in range(ntime):
+        field = 15 + 20 * np.cos(lat) + 5 * np.sin(3 * lon + 0.1 * i)
+        var[i] = field + rng.normal(0, 0.5, field.shape)
+    fl.close()
+
+
+def run(shape, tmpdir):
+    source = os.path.join(tmpdir, 'source.nc')
+    create_source(source, shape)
+    nbytes = 4 * int(np.prod(shape))
+
+    print('{:<22} {:<50} {:>8} {:>9} {:>9} {:>6}'.format(
+        'format', 'compression', 'time, s', 'MB/s', 'size, MB', 'ratio'))
+    for format, compression in SETTINGS:
+        nc = fnc.ncfile(Dataset(source))
+        nc.format = format
+        nc.compression = compression
+        fname = os.path.join(tmpdir, 'out.nc')
+        start = time.time()
+        nc.save(fname, passthrough=False)
+        elapsed = time.time() - start
+        size = os.path.getsize(fname)
+        print('{:<22} {:<50} {:>8.2f} {:>9.1f} {:>9.1f} {:>6.2f}'.format(
+            format, str(compression), elapsed, nbytes / elapsed / 1024**2,
+            size / 1024.**2, nbytes / float(size)))
+        nc.ifile.close()
+        os.remove(fname)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[50, 180, 360],
+                        metavar=('NTIME', 'NLAT', 'NLON'), help='shape of the variable')
+    parser.add_argument('--tmpdir', default=None, help='directory for the files')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        run(args.shape, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
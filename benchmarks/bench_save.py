@@ -0,0 +1,198 @@
+'''Timing of ncfile open, metadata edits and save on synthetic files.
+
+Creates synthetic file with given dimensions, number of variables and
+compression, and runs every case in a separate process, so the peak
+memory (RSS) of each case is measured on its own. Results can be saved
+as JSON to compare them between versions.
+
+Usage::
+
+    python benchmarks/bench_save.py --dims time=100 lat=180 lon=360 --nvars 4
+    python benchmarks/bench_save.py --nvars 2000 --dims time=10 x=10 --cases open edit
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from netCDF4 import Dataset
+
+import fixnc as fnc
+
+# name: (description, ncfile attributes, save keyword arguments)
+CASES = {
+    'open': ('open the file only', {}, None),
+    'edit': ('open and edit the header', {}, None),
+    'headeronly': ('edit and save the header in place of a copy', {}, {'headeronly': True}),
+    'save': ('edit and save', {}, {}),
+    'save-netcdf': ('edit and save through netCDF', {}, {'passthrough': False}),
+    'save-fast': ('edit and save with fast compression', {'compression': 'fast'}, {}),
+    'save-retype': ('edit, convert to float64 and save', {}, {}),
+    'save-pack': ('edit, pack to int16 and save', {}, {}),
+    'save-subset': ('edit, select half of every dimension and save', {}, {}),
+}
+
+
+def parse_dims(dims):
+    '''Dimensions from NAME=SIZE strings, the first one is unlimited.'''
+    parsed = []
+    for dim in dims:
+        name, size = dim.split('=')
+        parsed.append((name, int(size)))
+    return parsed
+
+
+def create_source(fname, dims, nvars, format, compression, seed=0):
+    '''Create file with `nvars` float32 variables of all `dims` and coordinate variables.'''
+    rng = np.random.RandomState(seed)
+    fl = Dataset(fname, 'w', format=format)
+    fl.title = 'synthetic file for fixnc benchmarks'
+    for i, (name, size) in enumerate(dims):
+        fl.createDimension(name, None if i == 0 else size)
+        coord = fl.createVariable(name, 'f8', (name,))
+        coord.units = 'unknown'
+        coord[:] = np.arange(size)
+    names = [name for name, size in dims]
+    kwargs = {}
+    if format.startswith('NETCDF4'):
+        kwargs = dict(fnc.COMPRESSION[compression])
+    shape = tuple(size for name, size in dims)
+    for n in range(nvars):
+        var = fl.createVariable('var{}'.format(n), 'f4', names, **kwargs)
+        var.long_name = 'variable {}'.format(n)
+        var.units = 'K'
+        # smooth field plus noise, written record by record
+        base = np.cumsum(rng.normal(0, 0.1, shape[1:]), axis=-1) if len(shape) > 1 else 0.
+        for i in range(shape[0]):
+            var[i] = base + rng.normal(0, 0.01, shape[1:]) + i
+    fl.close()
+    return 4 * nvars * int(np.prod(shape))
+
+
+def edit(nc):
+    '''Typical metadata edits: rename dimensions and variables, add and change attributes.'''
+    for dim in list(nc.dims):
+        nc.rename_dim(dim, dim + '_new')
+    for var in list(nc.variab):
+        if var.startswith('var'):
+            nc.rename_var(var, var.replace('var', 'field'))
+    for var in nc.variab:
+        nc.add_attr(var, 'comment', 'fixed with fixnc')
+        if 'units' in nc.variab[var]['attributes']:
+            nc.change_attr(var, 'units', 'degC')
+    nc.add_gattr('history', 'fixed with fixnc')
+
+
+def run_case(case, source, out):
+    '''Run one case, returns timings in seconds, sizes in bytes and peak RSS in MB.'''
+    description, attributes, kwargs = CASES[case]
+    result = {}
+    start = time.time()
+    nc = fnc.ncfile(Dataset(source))
+    result['open'] = time.time() - start
+    if case != 'open':
+        start = time.time()
+        edit(nc)
+        for var in nc.variab:
+            if not var.startswith('field'):
+                continue
+            if case == 'save-retype':
+                nc.change_dtype(var, 'float64')
+            elif case == 'save-pack':
+                nc.change_dtype(var, 'int16', pack=True)
+        if case == 'save-subset':
+            nc.isel(dict((dim, slice(0, max(size['size'] // 2, 1))) for dim, size in nc.dims.items()))
+        result['edit'] = time.time() - start
+    for name, value in attributes.items():
+        setattr(nc, name, value)
+    if kwargs is not None:
+        start = time.time()
+        nc.save(out, **kwargs)
+        result['save'] = time.time() - start
+        result['size'] = os.path.getsize(out)
+    nc.ifile.close()
+    # kB on Linux, bytes on macOS
+    scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+    result['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return result
+
+
+def run(args, tmpdir):
+    dims = parse_dims(args.dims)
+    source = os.path.join(tmpdir, 'source.nc')
+    start = time.time()
+    nbytes = create_source(source, dims, args.nvars, args.format, args.compression)
+    print('source: {} variables of ({}), {}, {} compression, {:.1f} MB of data, {:.1f} MB file, '
+          'created in {:.1f} s'.format(
+              args.nvars, ', '.join('{}={}'.format(*dim) for dim in dims), args.format,
+              args.compression, nbytes / 1024.**2, os.path.getsize(source) / 1024.**2,
+              time.time() - start))
+    print('{:<12} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9}'.format(
+        'case', 'open, s', 'edit, s', 'save, s', 'MB/s', 'size, MB', 'RSS, MB'))
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for case in args.cases:
+        out = os.path.join(tmpdir, 'out.nc')
+        if case == 'headeronly':
+            # edits are applied to the copy in place
+            shutil.copyfile(source, out)
+            casesource = out
+        else:
+            casesource = source
+        # fresh process for every case, for the peak memory of the case only
+        pool = context.Pool(1)
+        try:
+            result = pool.apply(run_case, (case, casesource, out))
+        finally:
+            pool.close()
+            pool.join()
+        result['case'] = case
+        results.append(result)
+        save = result.get('save')
+        print('{:<12} {:>8.3f} {:>8} {:>8} {:>9} {:>9} {:>9.1f}'.format(
+            case, result['open'],
+            '{:.3f}'.format(result['edit']) if 'edit' in result else '-',
+            '{:.2f}'.format(save) if save is not None else '-',
+            '{:.1f}'.format(nbytes / save / 1024.**2) if save else '-',
+            '{:.1f}'.format(result['size'] / 1024.**2) if 'size' in result else '-',
+            result['rss']))
+        if os.path.exists(out):
+            os.remove(out)
+
+    if args.json:
+        settings = {'dims': dims, 'nvars': args.nvars, 'format': args.format,
+                    'compression': args.compression, 'nbytes': nbytes}
+        with open(args.json, 'w') as outfile:
+            json.dump({'settings': settings, 'results': results}, outfile, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dims', nargs='+', default=['time=50', 'lat=180', 'lon=360'],
+                        metavar='NAME=SIZE', help='dimensions of the variables, the first is unlimited')
+    parser.add_argument('--nvars', type=int, default=4, help='number of variables')
+    parser.add_argument('--format', default='NETCDF4_CLASSIC', help='format of the source file')
+    parser.add_argument('--compression', default='none', choices=list(fnc.COMPRESSION),
+                        help='compression of the source file (NETCDF4 formats)')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES),
+                        help='cases to run')
+    parser.add_argument('--json', default=None, help='save the results to the JSON file')
+    parser.add_argument('--tmpdir', default=None, help='directory for the files')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        run(args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,40 @@
 import numpy as np
 from netCDF4 import Dataset
+from netCDF4 import Variable
 from netCDF4 import stringtoarr
 
-import sh
 from collections import OrderedDict
 import pickle
+import os
+import shutil
+from math import gcd
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import json
+import traceback
+import argparse
+import struct
+import time
+import itertools
+import copy
+import queue
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 import sys
 try:
@@ -14,8 +44,15 @@ except:
     pass
 
 
+# Compression presets, that can be used as `ncfile.compression`
+COMPRESSION = OrderedDict([
+    ('none', {}),
+    ('fast', {'zlib': True, 'complevel': 1, 'shuffle': True}),
+    ('archive', {'zlib': True, 'complevel': 6, 'shuffle': True}),
+])
+
 def create_variable(data, dimensions, hasunlimdim=False, datatype='float32', FillValue=None,
-                    attributes=OrderedDict()):
+                    attributes=OrderedDict(), chunking=None, filters=None, endian='native'):
     '''Creates dictionary that can be added as a variable to the netCDF file.
 
     Create  dictionary that contains information necessary for creation of the
@@ -23,8 +60,12 @@ def create_variable(data, dimensions, hasunlimdim=False, datatype='float32', Fil
 
     Parameters  
     ----------
-    data : array-like
+    data : array-like, callable or derived
         Numpy array, array-like object that contains the actual data values.
+        Data can be also computed on save slab by slab, without creating
+        the whole array: with a function, that gets the slab as a tuple of
+        slices along the `dimensions` and returns its values, or as
+        `derived` from other variables of the ncfile.
     dimensions : tuple
         tuple with dimension names, like ('time', 'lat', 'lon').
         dimensions should exist in the source file, or should be added
@@ -32,7 +73,8 @@ def create_variable(data, dimensions, hasunlimdim=False, datatype='float32', Fil
     hasunlimdim : bool
          True if variable have unlimited dimension, otherwise False.
          !!NOTE!! At present unlimited dimension in your new variable has
-         to be the same size as in the original data (e.g. number of time steps).
+         to be the same size as in the original data (e.g. number of time steps,
+         of all source files together if there are several).
          This should be changed.
     datatype: datatype
         numpy datatype as a string, like "float32".
@@ -40,6 +82,13 @@ def create_variable(data, dimensions, hasunlimdim=False, datatype='float32', Fil
         If your data should have one, otherwise None
     attributes: OrderedDict
         Orderd dictionary with attributes and their values.
+    chunking: 'contiguous' or list, optional
+        Chunk sizes along the dimensions, None for the netCDF library default.
+    filters: dict, optional
+        Compression filters, in the format of the netCDF4 `Variable.filters()`,
+        e.g. {'zlib': True, 'complevel': 4, 'shuffle': True}. None for no compression.
+    endian: str
+        'native', 'little' or 'big'.
 
     Returns
     -------
@@ -51,11 +100,64 @@ def create_variable(data, dimensions, hasunlimdim=False, datatype='float32', Fil
                         ('hasunlimdim',hasunlimdim),
                         ('datatype',np.dtype(datatype)),
                         ('FillValue',FillValue),
-                        ('attributes',attributes)])
+                        ('attributes',attributes),
+                        ('chunking',chunking),
+                        ('filters',filters),
+                        ('endian',endian)])
     return vvar
 
-def dump_variable(var, filename):
-    '''Use `pickle` to dump OrderedDict to the file.
+class derived(object):
+    '''Data of the variable, computed from other variables of the ncfile on save.
+
+    The values are computed slab by slab, together with the copy of the
+    data, so the whole array is never in memory.
+
+    Parameters
+    ----------
+    func : callable
+        Function, that gets slabs of the `variables` (numpy arrays) and
+        returns the slab of the new variable.
+    *variables : str
+        Names of the variables in the ncfile at the time of save. Variables should
+        have the same dimensions as the new variable.
+
+    Examples
+    --------
+    >>> speed = create_variable(derived(np.hypot, 'u', 'v'), ('time', 'lat', 'lon'), True)
+    >>> nc.add_var('speed', speed)
+    '''
+
+    def __init__(self, func, *variables):
+        self.func = func
+        self.variables = variables
+
+class _computed(object):
+    '''Read only array, that computes values of the slabs with `func(key)`.'''
+
+    def __init__(self, func, shape, dtype):
+        self.func = func
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return self.func(key)
+
+def dump_variable(var, filename, max_memory='512MB'):
+    '''Save the variable dictionary to the disk.
+
+    If `filename` ends with '.nc', the variable is saved to a small
+    netCDF file. Otherwise the metadata are saved to `filename` as JSON
+    and the data as raw numpy array to the .npy file with the same name
+    (e.g. temp.json and temp.npy), mask of the masked array, if there is
+    one, to .mask.npy file. Data, that are not numpy arrays (e.g. netCDF
+    variables), are copied in slabs of at most `max_memory`.
 
     Parameters
     ----------
@@ -63,35 +165,1036 @@ def dump_variable(var, filename):
         OrderedDict, supposedly produced by `create_variable` function.
     filename : str
         name of the file.
+    max_memory : int or str
+        Maximum size of the slab (see `parse_size`).
 
     Returns
     -------
     bool
         True is succes.
     '''
-    outfile = open(filename, 'wb')
-    pickle.dump(var, outfile)
-    outfile.close()
+    data = var['data']
+    if isinstance(data, derived) or (callable(data) and not hasattr(data, 'shape')):
+        raise ValueError('data computed on save can not be dumped')
+    budget = parse_size(max_memory)
+    metadata = OrderedDict((key, value) for key, value in var.items() if key != 'data')
+    if 'dimensions' in metadata:
+        metadata['dimensions'] = list(metadata['dimensions'])
+
+    if filename.endswith('.nc'):
+        _dump_netcdf(var, metadata, filename, budget)
+        return True
+
+    root = os.path.splitext(filename)[0]
+    npyname, maskname = root + '.npy', root + '.mask.npy'
+    mask = None
+    if isinstance(data, np.ndarray):
+        np.save(npyname, np.ma.getdata(data))
+        if np.ma.is_masked(data):
+            mask = np.ma.getmaskarray(data)
+            np.save(maskname, mask)
+    else:
+        # copied in slabs, the mask is created with the first masked slab
+        shape = tuple(data.shape)
+        out = np.lib.format.open_memmap(npyname, 'w+', np.dtype(data.dtype), shape)
+        for slab in _slabs(shape, out.dtype.itemsize, budget):
+            values = data[slab]
+            out[slab] = np.ma.getdata(values)
+            if np.ma.is_masked(values):
+                if mask is None:
+                    mask = np.lib.format.open_memmap(maskname, 'w+', bool, shape)
+                mask[slab] = np.ma.getmaskarray(values)
+        out.flush()
+        del out
+        if mask is not None:
+            mask.flush()
+    metadata['data'] = os.path.basename(npyname)
+    metadata['mask'] = os.path.basename(maskname) if mask is not None else None
+    del mask
+    with open(filename, 'w') as outfile:
+        json.dump(_encode(metadata), outfile, indent=2)
     return True
 
-def load_variable(filename):
-    '''Use `pickle` load OrderedDict from the file to the variable.
+def _dump_netcdf(var, metadata, filename, budget):
+    '''Save the variable dictionary to the netCDF file, as variable "data".'''
+    data = var['data']
+    shape = tuple(data.shape)
+    dimensions = metadata.get('dimensions', [])
+    ncfile4 = Dataset(filename, 'w', format='NETCDF4')
+    try:
+        dims = OrderedDict()
+        for i, dim in enumerate(dimensions):
+            unlimited = i == 0 and bool(metadata.get('hasunlimdim'))
+            ncfile4.createDimension(dim, None if unlimited else shape[i])
+            dims[dim] = OrderedDict([('size', shape[i]), ('isunlimited', unlimited)])
+        kwargs = _storage_kwargs(metadata.get('chunking'), metadata.get('filters'),
+                                 metadata.get('endian'), dimensions, dims, 'NETCDF4')
+        out = ncfile4.createVariable('data', np.dtype(metadata.get('datatype', data.dtype)),
+                                     dimensions, fill_value=metadata.get('FillValue'), **kwargs)
+        out.setncatts(metadata.get('attributes') or {})
+        if shape == ():
+            out[...] = data[...]
+        else:
+            for slab in _slabs(shape, np.dtype(data.dtype).itemsize, budget):
+                out[slab] = data[slab]
+    finally:
+        ncfile4.close()
+
+def load_variable(filename, allow_pickle=False):
+    '''Load the variable dictionary, saved by `dump_variable`.
+
+    Data are not read to memory: data from .npy files are memory mapped,
+    data from netCDF files are netCDF variables. Both are copied in slabs
+    by `ncfile.save`.
 
     Parameters
     ----------
     filename : str
         name of the file.
+    allow_pickle : bool
+        Load the files, saved with pickle by older versions of fixnc.
+        Loading of pickle files can execute arbitrary code, use it only
+        for the files you trust.
 
     Returns
     -------
     OrderedDict
 
     '''
-    ifile = open(filename, 'r')
-    var = pickle.load(ifile)
-    ifile.close()
+    if filename.endswith('.nc'):
+        ncvar = Dataset(filename).variables['data']
+        unlimdims = set(name for name, dim in ncvar.group().dimensions.items() if dim.isunlimited())
+        var = _lazyvar.fromvar(ncvar, unlimdims)
+        return OrderedDict((key, value) for key, value in var.items() if key != 'unlimdimname')
+
+    with open(filename, 'rb') as infile:
+        start = infile.read(1)
+        if start != b'{':
+            if not allow_pickle:
+                raise ValueError('{} is not a JSON file of the variable, use allow_pickle=True '
+                                 'to load pickle files of older versions'.format(filename))
+            infile.seek(0)
+            return pickle.load(infile)
+        infile.seek(0)
+        metadata = _decode(json.loads(infile.read().decode('utf-8')))
+
+    directory = os.path.dirname(filename)
+    data = np.load(os.path.join(directory, metadata.pop('data')), mmap_mode='r')
+    maskname = metadata.pop('mask', None)
+    if maskname is not None:
+        data = np.ma.masked_array(data, mask=np.load(os.path.join(directory, maskname), mmap_mode='r'))
+    var = OrderedDict([('data', data)])
+    var.update(metadata)
+    if 'dimensions' in var:
+        var['dimensions'] = tuple(var['dimensions'])
     return var
 
+def _copyvar(var):
+    '''Copy of the variable dictionary, data are not copied.'''
+    return OrderedDict((key, value if key == 'data' else copy.deepcopy(value))
+                       for key, value in var.items())
+
+def _inmemory(data):
+    '''True if data are numpy array in memory, not memory mapped from a file.'''
+    if not isinstance(data, np.ndarray):
+        return False
+    base = np.ma.getdata(data)
+    while base is not None:
+        if isinstance(base, np.memmap):
+            return False
+        base = getattr(base, 'base', None)
+    return True
+
+def _copyfile(src, dst):
+    '''Copy file, sharing the data blocks with the source if the file system allows it.
+
+    `os.copy_file_range` lets copy-on-write file systems (btrfs, XFS)
+    reflink the data instead of copying it. Falls back to `shutil.copyfile`.
+
+    Parameters
+    ----------
+    src : str
+        name of the source file.
+    dst : str
+        name of the destination file.
+    '''
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                left = os.fstat(fsrc.fileno()).st_size
+                while left > 0:
+                    ncopied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), left)
+                    if ncopied == 0:
+                        break
+                    left -= ncopied
+            if left == 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+def parse_size(size):
+    '''Convert size in bytes, like '512MB' or '2G', to the number of bytes.
+
+    Parameters
+    ----------
+    size : int or str
+        Number of bytes, or string with number and units (B, kB, MB, GB, TB,
+        multiples of 1024 bytes).
+
+    Returns
+    -------
+    int
+        Number of bytes.
+    '''
+    if isinstance(size, str):
+        units = {'': 1, 'B': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+        value = size.strip().upper()
+        for suffix in ('IB', 'B'):
+            if value.endswith(suffix) and value[:-len(suffix)][-1:] in 'KMGT':
+                value = value[:-len(suffix)]
+                break
+        if value[-1:] in units:
+            unit = value[-1:]
+            value = value[:-1]
+        else:
+            unit = ''
+        try:
+            return int(float(value) * units[unit])
+        except ValueError:
+            raise ValueError('can not convert {} to number of bytes'.format(size))
+    return int(size)
+
+def _slabs(shape, itemsize, budget):
+    '''Split array of the `shape` in slabs, that take no more than `budget` bytes.
+
+    The slabs are taken along the first axis, if one index of the first axis
+    does not fit in the budget, along the second one, and so on.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array.
+    itemsize : int
+        Size of one element in bytes.
+    budget : int
+        Maximum size of the slab in bytes.
+
+    Returns
+    -------
+    generator
+        Tuples of slices.
+    '''
+    shape = tuple(shape)
+    if len(shape) == 0:
+        yield ()
+        return
+    # find axis along which the slabs are taken
+    rowsize = itemsize * int(np.prod(shape, dtype=np.int64))
+    for axis in range(len(shape)):
+        rowsize = rowsize // max(shape[axis], 1)
+        if rowsize <= budget:
+            break
+    step = max(1, min(shape[axis], budget // max(rowsize, 1)))
+    for index in np.ndindex(*shape[:axis]):
+        head = tuple(slice(i, i+1) for i in index)
+        tail = tuple(slice(None) for i in shape[axis+1:])
+        for n in range(0, shape[axis], step):
+            yield head + (slice(n, min(n+step, shape[axis])),) + tail
+
+def _nrecords(recsize, budget, chunks=()):
+    '''Number of records along unlimited dimension, that are copied at once.
+
+    As many records as fit in the `budget`, rounded to the multiple of the
+    chunk lengths along unlimited dimension (or to the largest divisor of the
+    first chunk length, if one chunk does not fit), so that slabs are aligned with
+    the chunks on disk.
+
+    Parameters
+    ----------
+    recsize : int
+        Size of one record in bytes.
+    budget : int
+        Maximum size of the slab in bytes.
+    chunks : sequence
+        Chunk lengths along unlimited dimension in the source and in the
+        saved file, the first one has priority.
+
+    Returns
+    -------
+    int
+        Number of records.
+    '''
+    nrec = max(1, budget // max(recsize, 1))
+    chunks = [chunk for chunk in chunks if chunk and chunk > 1]
+    if not chunks:
+        return nrec
+    common = 1
+    for chunk in chunks:
+        common = common * chunk // gcd(common, chunk)
+    if nrec >= common:
+        return nrec // common * common
+    if nrec >= chunks[0]:
+        return nrec // chunks[0] * chunks[0]
+    # several slabs per chunk, the largest divisor of the chunk length
+    for divisor in range(nrec, 0, -1):
+        if chunks[0] % divisor == 0:
+            return divisor
+
+def _srckey(ranges, key):
+    '''Slices of the source data for the slices `key` of the saved data.
+
+    `ranges` are indexes of the source along every dimension, that are saved.
+    '''
+    src = []
+    for indexes, sl in zip(ranges, key):
+        sub = indexes[sl]
+        src.append(slice(sub.start, sub.stop, sub.step))
+    return tuple(src)
+
+def _chunklen(var):
+    '''Chunk length along the first dimension of the netCDF variable, None if not chunked.'''
+    try:
+        chunking = var.chunking()
+    except AttributeError:
+        return None
+    if isinstance(chunking, (list, tuple)) and len(chunking) > 0:
+        return chunking[0]
+    return None
+
+def _packvalue(value, packing, dtype):
+    '''Attribute value (e.g. valid_range) packed with scale_factor and add_offset of the packing.
+
+    Values are clipped to the range of the packed values, the FillValue is excluded.
+    '''
+    info = np.iinfo(dtype)
+    if dtype.kind == 'i':
+        low, high = int(info.min) + 1, int(info.max)
+    else:
+        low, high = int(info.min), int(info.max) - 1
+    packed = np.round((np.asarray(value, dtype=np.float64) - packing['add_offset']) /
+                      packing['scale_factor'])
+    return np.clip(packed, low, high).astype(dtype)
+
+def _fits(value, dtype):
+    '''True if the value(s) can be stored in the numeric data type without overflow.'''
+    values = np.asarray(value, dtype=np.float64)
+    if dtype.kind == 'f':
+        return bool(np.all(~np.isfinite(values) | (np.abs(values) <= np.finfo(dtype).max)))
+    info = np.iinfo(dtype)
+    return bool(np.all(np.isfinite(values) & (values >= info.min) & (values <= info.max)))
+
+def _normfilters(filters):
+    '''Filters in the format of `Variable.filters()`, with all the keys.'''
+    normal = OrderedDict([('zlib', False), ('szip', False), ('zstd', False),
+                          ('bzip2', False), ('blosc', False), ('shuffle', False),
+                          ('complevel', 0), ('fletcher32', False)])
+    normal.update(filters or {})
+    return dict(normal)
+
+def _storage_kwargs(chunking, filters, endian, dimensions, dims, format='NETCDF4_CLASSIC'):
+    '''Convert chunking, filters and endianness of the variable to `createVariable` arguments.
+
+    Parameters
+    ----------
+    chunking : 'contiguous', list or None
+        Output of `Variable.chunking()`. None for the netCDF library default.
+    filters : dict or None
+        Output of `Variable.filters()`. None for no compression.
+    endian : str or None
+        Output of `Variable.endian()`.
+    dimensions : tuple
+        Dimensions of the variable.
+    dims : OrderedDict
+        Dimensions of the ncfile.
+    format : str
+        Format of the netCDF file, there is no chunking, compression and
+        endianness control in NETCDF3 formats.
+
+    Returns
+    -------
+    dict
+    '''
+    kwargs = {}
+    if format.startswith('NETCDF3'):
+        return kwargs
+    filters = filters or {}
+    compressed = False
+    if filters.get('zlib'):
+        kwargs['zlib'] = True
+        kwargs['complevel'] = filters.get('complevel', 4)
+        compressed = True
+    for name in ('zstd', 'bzip2'):
+        if filters.get(name):
+            kwargs['compression'] = name
+            kwargs['complevel'] = filters.get('complevel', 4)
+            compressed = True
+    if filters.get('blosc'):
+        kwargs['compression'] = filters['blosc']['compressor']
+        kwargs['blosc_shuffle'] = filters['blosc']['shuffle']
+        kwargs['complevel'] = filters.get('complevel', 4)
+        compressed = True
+    if filters.get('szip'):
+        kwargs['compression'] = 'szip'
+        kwargs['szip_coding'] = filters['szip']['coding']
+        kwargs['szip_pixels_per_block'] = filters['szip']['pixels_per_block']
+        compressed = True
+    if filters:
+        kwargs['shuffle'] = bool(filters.get('shuffle'))
+        kwargs['fletcher32'] = bool(filters.get('fletcher32'))
+
+    unlimited = any(dims[dim]['isunlimited'] for dim in dimensions)
+    if chunking == 'contiguous':
+        # filters and unlimited dimensions need chunks, leave them to the library
+        if not (compressed or unlimited or filters.get('fletcher32')):
+            kwargs['contiguous'] = True
+    elif chunking:
+        chunksizes = []
+        for dim, size in zip(dimensions, chunking):
+            if not dims[dim]['isunlimited']:
+                size = min(size, dims[dim]['size'])
+            chunksizes.append(max(size, 1))
+        kwargs['chunksizes'] = chunksizes
+    if endian:
+        kwargs['endian'] = endian
+    return kwargs
+
+def _h5filters(dset):
+    '''Filter pipeline of the HDF5 dataset, as list of (filter id, parameters).'''
+    plist = dset.id.get_create_plist()
+    return [tuple(plist.get_filter(i)[0:3:2]) for i in range(plist.get_nfilters())]
+
+# Sizes of the netCDF classic data types (nc_type from the header)
+_CDF_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+def _cdf_layout(fname):
+    '''Positions of the variables in the netCDF classic (CDF-1, CDF-2 or CDF-5) file.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the file.
+
+    Returns
+    -------
+    tuple
+        (variables, recsize), where variables is a dictionary with
+        (offset of the data, is record variable) for every variable name
+        and recsize is the size of one record of all record variables in bytes.
+    '''
+    with open(fname, 'rb') as fl:
+        magic = fl.read(4)
+        if magic[:3] != b'CDF' or magic[3:] not in (b'\x01', b'\x02', b'\x05'):
+            raise ValueError('{} is not a netCDF classic file'.format(fname))
+        version = magic[3]
+        # counts and dimension ids are 64 bit in CDF-5, offsets in CDF-2 and CDF-5
+        count = '>q' if version == 5 else '>i'
+        offset = '>i' if version == 1 else '>q'
+
+        def read(fmt):
+            return struct.unpack(fmt, fl.read(struct.calcsize(fmt)))[0]
+
+        def name():
+            n = read(count)
+            value = fl.read(n).decode('utf-8')
+            fl.read(-n % 4)
+            return value
+
+        def skip_attributes():
+            read('>i') # NC_ATTRIBUTE or ABSENT
+            for i in range(read(count)):
+                name()
+                nctype = read('>i')
+                n = read(count) * _CDF_SIZES[nctype]
+                fl.seek(n + -n % 4, 1)
+
+        read(count) # number of records
+        read('>i') # NC_DIMENSION or ABSENT
+        dimsizes = []
+        for i in range(read(count)):
+            name()
+            dimsizes.append(read(count))
+        skip_attributes()
+
+        read('>i') # NC_VARIABLE or ABSENT
+        variables = OrderedDict()
+        recsizes = []
+        for i in range(read(count)):
+            varname = name()
+            dimids = [read(count) for j in range(read(count))]
+            skip_attributes()
+            nctype = read('>i')
+            vsize = read(count)
+            begin = read(offset)
+            isrec = len(dimids) > 0 and dimsizes[dimids[0]] == 0
+            variables[varname] = (begin, isrec)
+            if isrec:
+                nbytes = _CDF_SIZES[nctype] * int(np.prod([dimsizes[d] for d in dimids[1:]], dtype=np.int64))
+                recsizes.append((vsize, nbytes))
+
+    if len(recsizes) == 1:
+        # records of the only record variable are not padded
+        return variables, recsizes[0][1]
+    return variables, sum(vsize for vsize, nbytes in recsizes)
+
+class _lazyvar(OrderedDict):
+    '''Dictionary of the variable from the source file.
+
+    Data, dimensions and data type are set at once, the rest (FillValue,
+    attributes, chunking, filters, endian) is read from the file when
+    the dictionary is accessed for the first time. This way opening
+    of the files with thousands of variables stays cheap.
+    '''
+    _lazykeys = ('FillValue', 'attributes', 'chunking', 'filters', 'endian')
+
+    def __init__(self, *args, **kwargs):
+        self._ncvar = None
+        super(_lazyvar, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def fromvar(cls, ncvar, unlimdims, data=None):
+        '''Create the dictionary for the netCDF variable.
+
+        Parameters
+        ----------
+        ncvar : Variable
+            netCDF variable.
+        unlimdims : set
+            Names of unlimited dimensions.
+        data : array-like, optional
+            Data of the variable, if not `ncvar` itself.
+        '''
+        var = cls()
+        setitem = super(_lazyvar, var).__setitem__
+        setitem('data', ncvar if data is None else data)
+        dimensions = ncvar.dimensions
+        setitem('dimensions', dimensions)
+        hasunlimdim = False
+        for vdim in dimensions:
+            if vdim in unlimdims:
+                hasunlimdim = True
+                setitem('unlimdimname', vdim)
+        setitem('hasunlimdim', hasunlimdim)
+        setitem('datatype', ncvar.dtype)
+        var._ncvar = ncvar
+        return var
+
+    def _load(self):
+        ncvar = self._ncvar
+        if ncvar is None:
+            return
+        self._ncvar = None
+        setitem = super(_lazyvar, self).__setitem__
+
+        attdict = ncvar.__dict__
+        setitem('FillValue', attdict.pop('_FillValue', None))
+        setitem('attributes', attdict)
+
+        # Storage of the data in the file
+        setitem('chunking', ncvar.chunking())
+        setitem('filters', ncvar.filters())
+        setitem('endian', ncvar.endian())
+
+    def __getitem__(self, key):
+        if self._ncvar is not None and key in self._lazykeys:
+            self._load()
+        return super(_lazyvar, self).__getitem__(key)
+
+    def __contains__(self, key):
+        if self._ncvar is not None and key in self._lazykeys:
+            self._load()
+        return super(_lazyvar, self).__contains__(key)
+
+    def get(self, key, default=None):
+        if self._ncvar is not None and key in self._lazykeys:
+            self._load()
+        return super(_lazyvar, self).get(key, default)
+
+    def __setitem__(self, key, value):
+        # Replacing one of the eager keys keeps the rest unloaded
+        if self._ncvar is not None and not OrderedDict.__contains__(self, key):
+            self._load()
+        super(_lazyvar, self).__setitem__(key, value)
+
+def _loading(name):
+    '''Method of OrderedDict, that loads the _lazyvar first.'''
+    method = getattr(OrderedDict, name)
+
+    def loading(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+    loading.__name__ = name
+    loading.__doc__ = method.__doc__
+    return loading
+
+for _name in ('__delitem__', '__iter__', '__reversed__', '__len__',
+              '__eq__', '__ne__', '__repr__', '__reduce__', 'keys', 'values', 'items',
+              'pop', 'popitem', 'setdefault', 'update', 'copy', 'clear', 'move_to_end'):
+    setattr(_lazyvar, _name, _loading(_name))
+del _name
+
+class _concatvar(object):
+    '''Variables of several files, concatenated along the first (unlimited) dimension.
+
+    Works as a read only array, the data are read from the files only
+    when the variable is sliced.
+
+    Parameters
+    ----------
+    variables : list of Variable
+        Variables with the same data type and sizes of all dimensions but the first.
+    '''
+
+    def __init__(self, variables):
+        self.variables = list(variables)
+        self.offsets = np.cumsum([0] + [len(var) for var in self.variables])
+        first = self.variables[0]
+        self.shape = (int(self.offsets[-1]),) + first.shape[1:]
+        self.dtype = first.dtype
+        self.ndim = len(self.shape)
+        self.dimensions = first.dimensions
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunking(self):
+        return self.variables[0].chunking()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 0:
+            key = (slice(None),)
+        if key[0] is Ellipsis:
+            if len(key) > self.ndim:
+                return self[key[1:]]
+            first, rest = slice(None), key
+        else:
+            first, rest = key[0], key[1:]
+
+        index = np.arange(self.shape[0])[first]
+        if index.ndim == 0:
+            # single record
+            i = np.searchsorted(self.offsets, index, side='right') - 1
+            return self.variables[i][(int(index - self.offsets[i]),) + rest]
+
+        parts = []
+        for i, var in enumerate(self.variables):
+            local = index[(index >= self.offsets[i]) & (index < self.offsets[i + 1])] - self.offsets[i]
+            if len(local) == 0:
+                continue
+            step = local[1] - local[0] if len(local) > 1 else 1
+            if step > 0 and np.all(np.diff(local) == step):
+                local = slice(int(local[0]), int(local[-1]) + 1, int(step))
+            parts.append(var[(local,) + rest])
+        if not parts:
+            return self.variables[0][(slice(0, 0),) + rest]
+        if len(parts) == 1:
+            return parts[0]
+        if any(isinstance(part, np.ma.MaskedArray) for part in parts):
+            return np.ma.concatenate(parts)
+        return np.concatenate(parts)
+
+class _ncref(object):
+    '''Reference to the netCDF Dataset or Variable, that can be pickled.'''
+
+    def __init__(self, obj):
+        if isinstance(obj, Variable):
+            grp = obj.group()
+            self.name = obj.name
+        else:
+            grp = obj
+            self.name = None
+        while grp.parent is not None:
+            grp = grp.parent
+        self.path = grp.filepath()
+        self.group = obj.group().path if self.name is not None else '/'
+
+    def open(self, cache):
+        '''Reopen the object, datasets are reused from the `cache` dictionary.'''
+        if self.path not in cache:
+            cache[self.path] = Dataset(self.path)
+        ds = cache[self.path]
+        if self.name is None:
+            return ds
+        if self.group != '/':
+            ds = ds[self.group]
+        return ds.variables[self.name]
+
+def _toref(obj):
+    '''Replace netCDF objects in `obj` by references.'''
+    if isinstance(obj, (Variable, Dataset)):
+        return _ncref(obj)
+    if isinstance(obj, _concatvar):
+        ref = object.__new__(_concatvar)
+        ref.__dict__.update(obj.__dict__, variables=_toref(obj.variables))
+        return ref
+    if isinstance(obj, dict):
+        return obj.__class__((k, _toref(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_toref(v) for v in obj)
+    return obj
+
+def _fromref(obj, cache):
+    '''Replace references in `obj` by reopened netCDF objects.'''
+    if isinstance(obj, _ncref):
+        return obj.open(cache)
+    if isinstance(obj, _concatvar):
+        var = object.__new__(_concatvar)
+        var.__dict__.update(obj.__dict__, variables=_fromref(obj.variables, cache))
+        return var
+    if isinstance(obj, dict):
+        return obj.__class__((k, _fromref(v, cache)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_fromref(v, cache) for v in obj)
+    return obj
+
+# ncfile used by the worker processes of the parallel save
+_worker_nc = None
+
+def _init_worker(nc):
+    global _worker_nc
+    _worker_nc = nc
+
+def _stage_variable(vari, fname, chunking):
+    return _worker_nc._stage(vari, fname, chunking)
+
+def _check_header(first, other):
+    '''Raise ValueError if datasets can't be concatenated along the unlimited dimension.'''
+    def describe(ds):
+        dims = [(name, dim.isunlimited(), None if dim.isunlimited() else len(dim))
+                for name, dim in ds.dimensions.items()]
+        variables = [(name, var.dimensions, var.dtype) for name, var in ds.variables.items()]
+        return dims, variables
+
+    dims, variables = describe(first)
+    if not any(unlim for name, unlim, size in dims):
+        raise ValueError('{} has no unlimited dimension to concatenate along'.format(first.filepath()))
+    otherdims, othervariables = describe(other)
+    if otherdims != dims:
+        raise ValueError('dimensions of {} differ from {}'.format(other.filepath(), first.filepath()))
+    if othervariables != variables:
+        raise ValueError('variables of {} differ from {}'.format(other.filepath(), first.filepath()))
+
+def _peak_rss():
+    '''Peak resident memory of the process in bytes, None if it is not known.'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class savestats(object):
+    '''Statistics of `ncfile.save`: time of the phases and size of the data.
+
+    Phases are 'create' (creation of the variables), 'pack' (bounds of
+    the packed variables), 'read' (reading and decompression of the slabs
+    from the source, or waiting for them with `prefetch`), 'convert'
+    (conversion of data types), 'write' (compression and writing of the
+    slabs), 'sync' (checkpoints), 'passthrough' (copy of raw chunks), 'workers' (waiting
+    for the parallel workers and copy of their chunks) and 'close'.
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Function, that is called with the dictionary of every event:
+        'slab' and 'variable' (when the variable is written), with the
+        name of the variable, times and bytes, and 'done' at the end.
+    slabs : bool
+        Keep statistics of every slab, not only totals of the variables.
+
+    Attributes
+    ----------
+    phases : OrderedDict
+        Total time of the phases in seconds.
+    variables : OrderedDict
+        For every variable: 'method' ('copy', 'array', 'passthrough',
+        'workers' or 'resumed'), time of the 'phases', bytes 'read' and 'written' (size
+        of the data in memory, or of the compressed chunks for passthrough
+        and workers), 'peak_rss' after the variable and list of 'slabs'.
+    total : float
+        Time of the save in seconds.
+    peak_rss : int
+        Peak resident memory of the process in bytes.
+    '''
+
+    def __init__(self, callback=None, slabs=True):
+        self.callback = callback
+        self.keep_slabs = slabs
+        self.phases = OrderedDict()
+        self.variables = OrderedDict()
+        self.start = time.time()
+        self.total = None
+        self.peak_rss = None
+        # bytes written by all variables
+        self.written = 0
+
+    def _variable(self, vari):
+        if vari not in self.variables:
+            self.variables[vari] = OrderedDict([('method', None), ('phases', OrderedDict()),
+                                                ('read', 0), ('written', 0),
+                                                ('peak_rss', None), ('slabs', [])])
+        return self.variables[vari]
+
+    def add(self, vari, phase, seconds, read=0, written=0):
+        '''Add time of the phase and bytes read and written to the variable
+        (or only to the total, if `vari` is None).'''
+        self.phases[phase] = self.phases.get(phase, 0.) + seconds
+        self.written += written
+        if vari is not None:
+            stats = self._variable(vari)
+            stats['phases'][phase] = stats['phases'].get(phase, 0.) + seconds
+            stats['read'] += read
+            stats['written'] += written
+
+    def slab(self, vari, key, read, convert, write, nread, nwritten):
+        '''Add statistics of the slab `key` of the variable.'''
+        self.add(vari, 'read', read, read=nread)
+        self.add(vari, 'convert', convert)
+        self.add(vari, 'write', write, written=nwritten)
+        if isinstance(key, tuple):
+            key = [[sl.start, sl.stop] for sl in key]
+        else:
+            key = None
+        event = OrderedDict([('event', 'slab'), ('variable', vari), ('slab', key),
+                             ('read', read), ('convert', convert), ('write', write),
+                             ('bytes_read', nread), ('bytes_written', nwritten)])
+        if self.keep_slabs:
+            self._variable(vari)['slabs'].append(event)
+        self._notify(event)
+
+    def done_variable(self, vari, method):
+        '''Mark the variable as written by the `method`.'''
+        stats = self._variable(vari)
+        stats['method'] = method
+        stats['peak_rss'] = _peak_rss()
+        self._notify(OrderedDict([('event', 'variable'), ('variable', vari)] +
+                                 [(key, value) for key, value in stats.items() if key != 'slabs']))
+
+    def done(self):
+        '''Mark the end of the save.'''
+        self.total = time.time() - self.start
+        self.peak_rss = _peak_rss()
+        self._notify(OrderedDict([('event', 'done'), ('total', self.total),
+                                  ('peak_rss', self.peak_rss)]))
+
+    def _notify(self, event):
+        if self.callback is not None:
+            self.callback(event)
+
+    def summary(self):
+        '''Text table with the time of the phases and statistics of the variables.'''
+        mb = 1024.**2
+        lines = ['Total: {:.3f} s, peak memory: {}'.format(
+            self.total or 0., '{:.1f} MB'.format(self.peak_rss / mb) if self.peak_rss else 'unknown')]
+        lines.append('Phases: ' + ', '.join('{} {:.3f} s'.format(phase, seconds)
+                                            for phase, seconds in self.phases.items()))
+        lines.append('{:<20} {:<12} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+            'variable', 'method', 'read, MB', 'writ., MB', 'read, s', 'write, s', 'total, s', 'MB/s'))
+        for vari, stats in self.variables.items():
+            total = sum(stats['phases'].values())
+            lines.append('{:<20} {:<12} {:>9.2f} {:>9.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8}'.format(
+                vari, stats['method'] or '-', stats['read'] / mb, stats['written'] / mb,
+                stats['phases'].get('read', 0.), stats['phases'].get('write', 0.), total,
+                '{:.1f}'.format(stats['written'] / mb / total) if total > 0 else '-'))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+    def to_json(self, fname=None, slabs=True):
+        '''Statistics as JSON.
+
+        Parameters
+        ----------
+        fname : str, optional
+            Write JSON to the file.
+        slabs : bool
+            Include statistics of the slabs.
+
+        Returns
+        -------
+        str
+            JSON text.
+        '''
+        variables = OrderedDict()
+        for vari, stats in self.variables.items():
+            variables[vari] = OrderedDict((key, value) for key, value in stats.items()
+                                          if slabs or key != 'slabs')
+        text = json.dumps(OrderedDict([('total', self.total), ('peak_rss', self.peak_rss),
+                                       ('phases', self.phases), ('variables', variables)]),
+                          indent=2)
+        if fname is not None:
+            with open(fname, 'w') as outfile:
+                outfile.write(text)
+        return text
+
+# Checkpoints of the resumable save, if they are not set by sync_bytes or sync_variables
+_RESUME_SYNC = '1GB'
+
+class _checkpoints(object):
+    '''Flushes of the file on save, after `nbytes` of written data and/or
+    `nvariables` variables.
+
+    If `progname` is given, the progress of the save (variables and slabs
+    written before the flush) is recorded in this JSON file with the `key`
+    of the save, so an interrupted save can be resumed.
+    '''
+
+    def __init__(self, ncfile4, stats, nbytes=None, nvariables=None, progname=None,
+                 key=None, done=None, slabs=None):
+        self.ncfile4 = ncfile4
+        self.stats = stats
+        self.nbytes = parse_size(nbytes) if nbytes is not None else None
+        self.nvariables = nvariables
+        self.progname = progname
+        self.key = key
+        self.done = list(done or [])
+        self.slabs = OrderedDict(slabs or {})
+        self.synced = stats.written
+        self.unsynced = 0
+
+    def slab(self, vari):
+        '''Slab of the variable is written.'''
+        self.slabs[vari] = self.slabs.get(vari, 0) + 1
+        if self.nbytes is not None and self.stats.written - self.synced >= self.nbytes:
+            self.sync(vari)
+
+    def variable(self, vari):
+        '''All data of the variable are written.'''
+        self.slabs.pop(vari, None)
+        self.done.append(vari)
+        self.unsynced += 1
+        if ((self.nbytes is not None and self.stats.written - self.synced >= self.nbytes) or
+                (self.nvariables is not None and self.unsynced >= self.nvariables)):
+            self.sync(vari)
+
+    def sync(self, vari):
+        start = time.time()
+        self.ncfile4.sync() # checkpoint, flush data to disk
+        self.stats.add(vari, 'sync', time.time() - start)
+        self.synced = self.stats.written
+        self.unsynced = 0
+        if self.progname is not None:
+            tmpname = self.progname + '.tmp'
+            with open(tmpname, 'w') as outfile:
+                json.dump(OrderedDict([('key', self.key), ('done', self.done),
+                                       ('slabs', self.slabs)]), outfile)
+            os.replace(tmpname, self.progname)
+
+def _read_slabs(nc, tasks, results, free, shmname, slotsize):
+    '''Read slabs of the variables of the ncfile `nc`, requested as
+    (variable name, list of slabs) in `tasks`.
+
+    Every slab is copied to a free slot (from the `free` queue) of the
+    shared memory `shmname` and (slot, shape, dtype, mask, None) is put
+    to `results`. Slabs, that do not fit in the slot, are sent as
+    (slot, None, None, mask, data).
+    '''
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(shmname)
+    try:
+        for vari, keys in iter(tasks.get, None):
+            data, switched = nc._source(vari, nc.variab[vari])
+            for key in keys:
+                slab = data[key]
+                mask = None
+                if isinstance(slab, np.ma.MaskedArray) and slab.mask is not np.ma.nomask:
+                    mask = slab.mask
+                slab = np.asarray(np.ma.getdata(slab))
+                slot = free.get()
+                if slab.nbytes > slotsize or slab.dtype.hasobject:
+                    results.put((slot, None, None, mask, slab))
+                    continue
+                view = np.ndarray(slab.shape, slab.dtype, buffer=shm.buf, offset=slot * slotsize)
+                view[...] = slab
+                del view
+                results.put((slot, slab.shape, slab.dtype.str, mask, None))
+    except Exception:
+        results.put(RuntimeError('reading of the slabs failed:\n' + traceback.format_exc()))
+    finally:
+        shm.close()
+
+class _prefetcher(object):
+    '''Process, that reads slabs of the variables ahead of `ncfile.save`.
+
+    Slabs are passed through shared memory with `size` slots of `slotsize` bytes.
+
+    Parameters
+    ----------
+    nc : ncfile
+        The ncfile, that can be pickled.
+    size : int
+        Maximum number of slabs read ahead.
+    slotsize : int
+        Maximum size of the slab in bytes.
+    '''
+
+    def __init__(self, nc, size, slotsize):
+        from multiprocessing import shared_memory
+        context = multiprocessing.get_context('spawn')
+        self.slotsize = max(slotsize, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=size * self.slotsize)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.free = context.Queue()
+        for slot in range(size):
+            self.free.put(slot)
+        self.current = None
+        self.process = context.Process(target=_read_slabs,
+                                       args=(nc, self.tasks, self.results, self.free,
+                                             self.shm.name, self.slotsize))
+        self.process.daemon = True
+        self.process.start()
+
+    def read(self, vari, keys):
+        '''Request slabs `keys` of the variable `vari`.'''
+        self.tasks.put((vari, keys))
+
+    def get(self):
+        '''Next slab, in the order they were requested.
+
+        The slab is valid until the next call of `get`.
+        '''
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+        while True:
+            try:
+                item = self.results.get(timeout=1.)
+                break
+            except queue.Empty:
+                # slabs, sent before the process exited, are still taken
+                if self.process.exitcode is not None and self.results.empty():
+                    raise RuntimeError('reading of the slabs failed: the process exited with code {}'.format(
+                        self.process.exitcode))
+        if isinstance(item, Exception):
+            raise item
+        self.current, shape, dtype, mask, slab = item
+        if slab is None:
+            slab = np.ndarray(shape, dtype, buffer=self.shm.buf, offset=self.current * self.slotsize)
+        if mask is not None:
+            slab = np.ma.masked_array(slab, mask=mask)
+        return slab
+
+    def close(self):
+        self.tasks.put(None)
+        self.process.join()
+        self._release()
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self._release()
+
+    def _release(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # there are still views of the memory, it is released with them
+            pass
+        self.shm.unlink()
+
 def reorder(odict, neworder):
     '''Reorder values in the OrderedDict
 
@@ -137,19 +1240,64 @@ class ncfile(object):
 
     Parameters
     ----------
-    ifile : Dataset
+    ifile : Dataset or list of Dataset
         Instance of the Dataset class from the netCDF4 library.
+        If there is a list of datasets with the same header (e.g. monthly
+        files), their data are concatenated along the unlimited dimension.
+        The header is taken from the first dataset and the files are
+        read one after another on save.
 
     '''
 
     def __init__(self, ifile):
 
+        if isinstance(ifile, (list, tuple)):
+            if len(ifile) == 0:
+                raise ValueError('there should be at least one dataset')
+            ifiles = list(ifile)
+            ifile = ifiles[0]
+            for other in ifiles[1:]:
+                _check_header(ifile, other)
+        else:
+            ifiles = [ifile]
         self.ifile = ifile
-        self.nchunk = 10
-        self.istop = -1
-        self.nchunk = 10
+        # All source datasets, concatenated along the unlimited dimension
+        self.ifiles = ifiles
+        # Number of records along unlimited dimension copied at once,
+        # 'auto' to choose it from the size of records, chunks and `max_memory`
+        self.nchunk = 'auto'
         self.istart = 0
         self.istop = -1
+        # Indexes of the dimensions in the source, that are saved (see `isel`)
+        self.selection = OrderedDict()
+        # Positions of the variables in netCDF classic source files, by file name
+        self._layouts = {}
+        # Statistics of the last save (savestats)
+        self.stats = None
+        # Maximum size of the data, that are read at once on save
+        self.max_memory = '512MB'
+        # Number of slabs read ahead by a separate process on save, while the
+        # previous slabs are written; 0 to read and write in turns.
+        # Up to prefetch + 1 slabs of `max_memory` are in memory at once.
+        self.prefetch = 0
+        # Checkpoints on save: the file is flushed to disk after every
+        # `sync_bytes` (size, e.g. '1GB') of written data and/or every
+        # `sync_variables` variables. None (default) - flush only on close.
+        self.sync_bytes = None
+        self.sync_variables = None
+        # Function of variable name and variable dictionary, that returns
+        # chunking of the variable on save instead of its 'chunking'
+        self.rechunk = None
+        # Format of the saved file, None - NETCDF4_CLASSIC
+        self.format = None
+        # Compression of the saved file: None to keep filters of the variables,
+        # name of the preset from COMPRESSION or dictionary with filters.
+        # Filters changed with `change_filters` are always kept.
+        self.compression = None
+        # Edits applied to the ncfile, as (method name, arguments) tuples
+        self.edits = []
+        # Per variable journal of changes, variables without entry are untouched
+        self.journal = OrderedDict()
 
         # Read dimensions
         dims = OrderedDict()
@@ -162,11 +1310,13 @@ class ncfile(object):
 
             dims[dimname]['size'] = len(dim)
             dims[dimname]['isunlimited'] = dim.isunlimited()
+            if dim.isunlimited():
+                dims[dimname]['size'] = sum(len(ds.dimensions[dimname]) for ds in ifiles)
 
         self.dims = dims
 
         # Read variable names
-        varnames = ifile.variables.keys()
+        varnames = list(ifile.variables.keys())
 
         # I am not sure what this fix is for...
         for dimname in ifile.dimensions.keys():
@@ -175,30 +1325,15 @@ class ncfile(object):
 
         self.varnames = varnames
 
-        # Collect variables
+        # Collect variables, attributes and storage are read on first access
+        unlimdims = set(name for name, dim in dims.items() if dim['isunlimited'])
         variab = OrderedDict()
         for varname in varnames:
-            variab[varname] = OrderedDict()
             ncvar = ifile.variables[varname]
-            variab[varname]['data'] = ncvar
-            variab[varname]['dimensions']= ncvar.dimensions
-            hasunlimdim = False
-            # Check if dimension is unlimited
-            for vdim in variab[varname]['dimensions']:
-                if ifile.dimensions[vdim].isunlimited():
-                    hasunlimdim = True
-                    variab[varname]['unlimdimname'] = vdim
-            variab[varname]['hasunlimdim'] = hasunlimdim
-            variab[varname]['datatype'] =  ncvar.dtype
-
-            if hasattr(ncvar, '_FillValue'):
-                variab[varname]['FillValue'] = ncvar._FillValue
-            else:
-                variab[varname]['FillValue'] = None
-
-            attdict = ncvar.__dict__
-            if '_FillValue' in attdict: del attdict['_FillValue']
-            variab[varname]['attributes'] = attdict
+            data = None
+            if len(ifiles) > 1 and set(ncvar.dimensions) & unlimdims:
+                data = _concatvar([ds.variables[varname] for ds in ifiles])
+            variab[varname] = _lazyvar.fromvar(ncvar, unlimdims, data)
 
         self.variab = variab
 
@@ -211,7 +1346,80 @@ class ncfile(object):
             #setattr(ncfile4, gatt, getattr(self.ifile,gatt))
         self.gattrs = gattrs
 
+    # Edits that only change the header and can be applied to the file in place
+    _header_edits = ('rename_dim', 'rename_var', 'rename_attr', 'rename_gattr',
+                     'change_attr', 'change_gattr', 'add_attr', 'add_gattr', 'del_attr')
+
+    @property
+    def headeronly(self):
+        '''True if all edits only change the header of the file.
+
+        Only in this case the ncfile can be saved with `headeronly=True`.
+        '''
+        # source names of the renamed variables and dimensions
+        variables, dims = {}, {}
+        for name, args in self.edits:
+            if name not in self._header_edits:
+                return False
+            if name == 'rename_dim' and not args[2]:
+                return False
+            if name == 'rename_var':
+                variables[args[1]] = variables.pop(args[0], args[0])
+            if name == 'rename_dim':
+                dims[args[1]] = dims.pop(args[0], args[0])
+        if len(self.ifiles) > 1:
+            return False
+        # netCDF-4 library loses data of the coordinate variable, if it is
+        # renamed together with its dimension
+        coords = set(variables.values()) & set(dims.values()) & set(self.ifile.dimensions)
+        if coords and self.ifile.data_model.startswith('NETCDF4'):
+            return False
+        return self.istart == 0 and self.istop in (-1, self._unlimsize())
+
+    def _unlimsize(self):
+        '''Size of the unlimited dimension in the source file, -1 if there is none.'''
+        for dim in self.ifile.dimensions.values():
+            if dim.isunlimited():
+                return len(dim)
+        return -1
+
+    def _log(self, var, change):
+        '''Add the change to the journal of the variable.'''
+        if var not in self.journal:
+            self.journal[var] = OrderedDict([('source', var), ('changes', [])])
+        if change not in self.journal[var]['changes']:
+            self.journal[var]['changes'].append(change)
+
+    def status(self, var):
+        '''Classify changes of the variable.
+
+        The class defines how the data of the variable are written by `save`.
+
+        Parameters
+        ----------
+        var : str
+            Name of the variable.
 
+        Returns
+        -------
+        str
+            'untouched' if there are no changes, 'metadata' if only name,
+            names of dimensions or attributes are changed (data are copied
+            as they are), 'retyped' if data type is changed (data are
+            converted), 'redataed' if data are changed or 'added' if the
+            variable is new (data are written from the new values).
+            Changes of chunking, filters or endianness are 'metadata' as well,
+            but the data are recompressed.
+        '''
+        if var not in self.journal:
+            return 'untouched'
+        changes = self.journal[var]['changes']
+        for status in ('added', 'redataed', 'retyped'):
+            if status in changes:
+                return status
+        if changes:
+            return 'metadata'
+        return 'untouched'
 
     def rename_dim(self, oldname, newname, renameall = True):
         """Rename existing dimension.
@@ -232,9 +1440,13 @@ class ncfile(object):
                              self.dims.items())
         newdim[newname]['name'] = newname
         self.dims = newdim
+        if oldname in self.selection:
+            self.selection = OrderedDict((newname if k == oldname else k, v) for k, v in
+                                         self.selection.items())
         if renameall:
             for var in self.variab:
-                self.rename_dim_invar(var, oldname, newname)
+                self._rename_dim_invar(var, oldname, newname)
+        self.edits.append(('rename_dim', (oldname, newname, renameall)))
 
     def rename_dim_invar(self, var, oldname, newname):
         """Rename dimension in the variable.
@@ -249,6 +1461,10 @@ class ncfile(object):
             New name of the dimension.
 
         """
+        self._rename_dim_invar(var, oldname, newname)
+        self.edits.append(('rename_dim_invar', (var, oldname, newname)))
+
+    def _rename_dim_invar(self, var, oldname, newname):
         vardims = self.variab[var]['dimensions']
         if oldname in vardims:
                     #print 'find old name'
@@ -258,6 +1474,7 @@ class ncfile(object):
                     tempdim[i] = newname
 
             self.variab[var]['dimensions'] = tuple(tempdim)
+            self._log(var, 'redimensioned')
 
     def rename_attr(self, var, oldname, newname):
         """Rename existing attribute of the variable.
@@ -278,6 +1495,8 @@ class ncfile(object):
         newattr = OrderedDict((newname if k == oldname else k, v) for k, v in
                              self.variab[var]['attributes'].items())
         self.variab[var]['attributes'] = newattr
+        self._log(var, 'reattributed')
+        self.edits.append(('rename_attr', (var, oldname, newname)))
 
     def rename_gattr(self, oldname, newname):
         """Rename existing global attribute.
@@ -296,6 +1515,7 @@ class ncfile(object):
         newattr = OrderedDict((newname if k == oldname else k, v) for k, v in
                              self.gattrs.items())
         self.gattrs = newattr
+        self.edits.append(('rename_gattr', (oldname, newname)))
 
     def change_attr(self, var, attrname, newvalue):
         '''Change the value of the attribute in specified variable.
@@ -313,6 +1533,8 @@ class ncfile(object):
         '''
         if attrname in self.variab[var]['attributes']:
             self.variab[var]['attributes'][attrname] = newvalue
+            self._log(var, 'reattributed')
+            self.edits.append(('change_attr', (var, attrname, newvalue)))
         else:
             raise ValueError('there is no attribute with name {} in variable {}'.format(attrname, var))
 
@@ -330,6 +1552,7 @@ class ncfile(object):
         '''
         if attrname in self.gattrs:
             self.gattrs[attrname] = newvalue
+            self.edits.append(('change_gattr', (attrname, newvalue)))
         else:
             raise ValueError('there is no global attribute with name {}'.format(attrname))
 
@@ -343,18 +1566,26 @@ class ncfile(object):
         ----------
         var : str
             Name of the variable.
-        data : array-like
+        data : array-like, callable or derived
             Array with new data values of the variable.
             The size should be the same as for the original data.
+            See `create_variable` for the data computed on save.
         '''
         self.variab[var]['data'] = data
+        self._log(var, 'redataed')
+        self.edits.append(('change_data', (var, data)))
 
-    def change_dtype(self, var, dtype):
+    def change_dtype(self, var, dtype, pack=False, bounds=None):
         '''Change data type values in the existing variable.
 
         Should be exactly the same shape as original data.
         Data should be numpy array, or array-like object.
 
+        Data are converted slab by slab on save. If the values do not fit
+        in the new data type, save raises ValueError. The maximum absolute
+        difference between the original and the saved values is stored as
+        'max_error' in ``journal[var]['precision']``.
+
         Parameters
         ----------
         var : str
@@ -362,8 +1593,79 @@ class ncfile(object):
         dtype : numpy dtype, e.g. npumpy.dtype('float16')
             Array with new data values of the variable.
             The size should be the same as for the original data.
+        pack : bool
+            If True, values are packed to integer `dtype` with scale_factor
+            and add_offset attributes, computed from `bounds`. The largest
+            negative (or, for unsigned types, the largest positive) value
+            is reserved for the FillValue.
+        bounds : tuple, optional
+            (minimum, maximum) of the packed values. By default it is
+            computed from the data on save, with an additional pass over them.
         '''
+        dtype = np.dtype(dtype)
+        if pack and dtype.kind not in 'iu':
+            raise ValueError('data can be packed only to integer data types, not {}'.format(dtype))
         self.variab[var]['datatype'] = dtype
+        if pack:
+            self.variab[var]['packing'] = OrderedDict([('bounds', bounds)])
+        elif 'packing' in self.variab[var]:
+            del self.variab[var]['packing']
+        self._log(var, 'retyped')
+        if pack:
+            self.edits.append(('change_dtype', (var, dtype, pack, bounds)))
+        else:
+            self.edits.append(('change_dtype', (var, dtype)))
+
+    def change_chunking(self, var, chunking):
+        '''Change chunking of the variable in the saved file.
+
+        Parameters
+        ----------
+        var : str
+            Name of the variable.
+        chunking : 'contiguous', list or None
+            'contiguous', list with chunk sizes along the dimensions
+            of the variable, or None for the netCDF library default.
+        '''
+        self.variab[var]['chunking'] = chunking
+        self._log(var, 'rechunked')
+        self.edits.append(('change_chunking', (var, chunking)))
+
+    def change_filters(self, var, filters=None, **kwargs):
+        '''Change compression filters of the variable in the saved file.
+
+        Filters that are not given stay the same.
+
+        Parameters
+        ----------
+        var : str
+            Name of the variable.
+        filters : dict, optional
+            Filters in the format of the netCDF4 `Variable.filters()`.
+        **kwargs
+            Filters as keyword arguments, e.g. zlib=True, complevel=4,
+            shuffle=True, fletcher32=False.
+        '''
+        filters = dict(filters or {}, **kwargs)
+        newfilters = _normfilters(self.variab[var].get('filters'))
+        newfilters.update(filters)
+        self.variab[var]['filters'] = newfilters
+        self._log(var, 'refiltered')
+        self.edits.append(('change_filters', (var, filters)))
+
+    def change_endian(self, var, endian):
+        '''Change endianness of the variable in the saved file.
+
+        Parameters
+        ----------
+        var : str
+            Name of the variable.
+        endian : str
+            'native', 'little' or 'big'.
+        '''
+        self.variab[var]['endian'] = endian
+        self._log(var, 'reendianed')
+        self.edits.append(('change_endian', (var, endian)))
 
     def rename_var(self, oldname, newname):
         """Rename existing variable.
@@ -382,6 +1684,15 @@ class ncfile(object):
             newvar = OrderedDict((newname if k == oldname else k, v) for k, v in
                              self.variab.items())
             self.variab = newvar
+            entry = self.journal.pop(oldname, None)
+            if entry is None:
+                entry = OrderedDict([('source', oldname), ('changes', [])])
+            if newname == entry['source']:
+                entry['changes'] = [c for c in entry['changes'] if c != 'renamed']
+            elif 'renamed' not in entry['changes']:
+                entry['changes'].append('renamed')
+            self.journal[newname] = entry
+            self.edits.append(('rename_var', (oldname, newname)))
         else:
             raise ValueError('there is no variable with name {}'.format(oldname))
 
@@ -403,6 +1714,7 @@ class ncfile(object):
         self.dims[name]['name'] = name
         self.dims[name]['size'] = size
         self.dims[name]['isunlimited'] = isunlimited
+        self.edits.append(('add_dim', (name, size, isunlimited)))
 
     def add_attr(self, var, attr, value):
         """Add attribute to the variable.
@@ -419,6 +1731,8 @@ class ncfile(object):
         """
 
         self.variab[var]['attributes'][attr] = value
+        self._log(var, 'reattributed')
+        self.edits.append(('add_attr', (var, attr, value)))
 
     def add_gattr(self, attr, value):
         """Add global attribute.
@@ -432,6 +1746,7 @@ class ncfile(object):
 
         """
         self.gattrs[attr] = value
+        self.edits.append(('add_gattr', (attr, value)))
 
     def add_var(self, varname, var):
         """Add variable.
@@ -444,7 +1759,12 @@ class ncfile(object):
             Should be OrderedDict, prepared with `create_variable` function.
 
         """
+        if 'dimensions' in var:
+            var['dimensions'] = tuple(var['dimensions'])
         self.variab[varname] = var
+        self.journal[varname] = OrderedDict([('source', None), ('changes', ['added'])])
+        # later edits of the variable should not change the recorded one
+        self.edits.append(('add_var', (varname, _copyvar(var))))
 
     def del_attr(self, var, attr):
         """Delete attribute from the variable.
@@ -459,6 +1779,8 @@ class ncfile(object):
         """
         if attr in self.variab[var]['attributes']:
             del self.variab[var]['attributes'][attr]
+            self._log(var, 'reattributed')
+            self.edits.append(('del_attr', (var, attr)))
         else:
             raise ValueError('there is no attribute with name {} in variable {} '.format(attr, var))
 
@@ -471,8 +1793,10 @@ class ncfile(object):
             Name of the variable.
         
         """
-        if self.variab[var]:
+        if var in self.variab:
             del self.variab[var]
+            self.journal.pop(var, None)
+            self.edits.append(('del_var', (var,)))
         else:
             raise ValueError('there is no variable with name {} '.format(var))
 
@@ -489,6 +1813,7 @@ class ncfile(object):
 
         ordered = reorder(self.dims, neworder)
         self.dims = ordered
+        self.edits.append(('reorder_dims', (neworder,)))
 
     def reorder_vars(self, neworder):
         """Reorder variables.
@@ -501,90 +1826,939 @@ class ncfile(object):
         """
         ordered = reorder(self.variab, neworder)
         self.variab = ordered
+        self.edits.append(('reorder_vars', (neworder,)))
 
+    def isel(self, selection=None, **slices):
+        '''Select index ranges of the dimensions, that are saved.
 
-    def save(self, fname):
-        '''Save the file to the disk.
-
-        Create netCDF file from the ncfile object.
+        Nothing is read at this point, `save` reads only the selected
+        parts of the variables from the source file. Selection applies
+        to the data of all variables with the dimension, new data should
+        have the size of the dimension before the selection. On the
+        unlimited dimension `istart` and `istop` are applied as well.
 
         Parameters
         ----------
-        fname : str
-            File name.
-
+        selection : dict, optional
+            Dimension names and slices, the same as keyword arguments.
+        **slices : slice or int
+            Slices with positive step (or indexes) of the dimensions, e.g.
+            ``nc.isel(time=slice(0, 12), lat=slice(100, 200))``.
+            Slices are relative to the previous selection of the dimension.
 
         '''
+        slices = OrderedDict(selection or {}, **slices)
+        for dim, sel in slices.items():
+            if dim not in self.dims:
+                raise ValueError('there is no dimension {}'.format(dim))
+            indexes = self.selection.get(dim, range(self.dims[dim]['size']))
+            if isinstance(sel, slice):
+                if sel.step is not None and sel.step < 1:
+                    raise ValueError('step of the slice of {} should be positive'.format(dim))
+                indexes = indexes[sel]
+            else:
+                index = indexes[sel]
+                indexes = range(index, index + 1)
+            if len(indexes) == 0:
+                raise ValueError('selection of {} is empty'.format(dim))
+            self.selection[dim] = indexes
+            self.dims[dim]['size'] = len(indexes)
+        self.edits.append(('isel', (slices,)))
+
+    def _ranges(self, perem, shape):
+        '''Indexes of the source data along the dimensions of the variable, that are saved.'''
+        ranges = []
+        for i, dim in enumerate(perem['dimensions']):
+            indexes = self.selection.get(dim, range(shape[i]))
+            if i == 0 and perem['hasunlimdim'] and (self.istart != 0 or self.istop != -1):
+                # only indexes between istart and istop
+                stop = shape[0] if self.istop == -1 else self.istop
+                first = max(0, -(-(self.istart - indexes.start) // indexes.step))
+                last = max(0, -(-(stop - indexes.start) // indexes.step))
+                indexes = indexes[first:last]
+            ranges.append(indexes)
+        return ranges
+
+
+    def save(self, fname, headeronly=False, passthrough=True, workers=None, stats=None,
+             resume=False):
+        '''Save the file to the disk, or to memory.
+
+        Create netCDF file from the ncfile object. Format of the file is
+        `format` attribute (NETCDF4_CLASSIC by default), compression of the variables is defined by
+        `compression` attribute and filters of the variables.
+
+        Parameters
+        ----------
+        fname : str, file-like or None
+            File name. If None, the file is created in memory (netCDF4
+            in-memory dataset) and its content is returned. If file-like
+            object (with `write` method), the file is created in memory and
+            written to it. Raw chunks are not copied (`passthrough` and
+            `workers` are ignored), `headeronly` and `resume` are not possible
+            in this case.
+        headeronly : bool
+            If True, do not rewrite the data. The source file is copied
+            to `fname` (or used directly, if `fname` is the source file) and
+            the edits are applied to its header in place. Possible only if all
+            edits change metadata (see `headeronly` property). The format
+            of the source file is preserved. If the source file is edited
+            in place, the ncfile is initialized from it after the save, also
+            if an edit fails (edits before it stay in the file then).
+        passthrough : bool
+            If True (and h5py is installed and format is NETCDF4), compressed chunks of the variables
+            with unchanged data, data type and dimension sizes in netCDF4 source
+            files are copied byte for byte, without decompression and
+            compression. Chunking and filters of such variables are the same
+            as in the source file.
+        workers : int, optional
+            Number of processes that read and compress the variables in
+            parallel (requires h5py). Every chunked variable, copied from a file,
+            is written by a worker to a separate file and then its compressed
+            chunks are copied to `fname`. The result is the same as of the serial save.
+            Ignored for NETCDF3 formats.
+            Workers are started with the 'spawn' method, so scripts that use
+            them should be protected with ``if __name__ == '__main__':``.
+        stats : savestats, optional
+            Statistics to fill, e.g. with a callback. By default new
+            statistics are created. They are available as `stats` attribute
+            after the save.
+        resume : bool
+            If True, the progress of the save is recorded at the checkpoints
+            (see below, by default after every variable and every 1GB of
+            data), and the save continues from the last checkpoint of the
+            previous interrupted save of the same ncfile to `fname`.
+
+        The file is written to `fname`.part and renamed to `fname` when it is
+        complete, so an existing `fname` is kept if the save fails, and the
+        source file can be saved to its own name. In this case the ncfile is
+        initialized from the saved file (edits are applied to it already),
+        the attributes, that control the save, are kept. With `resume` the
+        unfinished `fname`.part and its progress (`fname`.part.json) are kept
+        for the next save. The edits and settings of the ncfile should be the
+        same, when the save is resumed; changes of the variables, data
+        types, dimensions, source files and `max_memory` are detected, and the
+        save starts over in this case.
+
+        With `prefetch` > 0 the data of the variables from the source files
+        are read by a separate process (also started with 'spawn'), that keeps
+        up to `prefetch` slabs ahead of the slabs, that are written.
+
+        The file is flushed to disk only when it is closed, unless `sync_bytes`
+        or `sync_variables` are set (checkpoints, e.g. for long saves).
+
+        Returns
+        -------
+        bytes or None
+            Content of the file, if `fname` is None.
 
+        '''
+        if stats is None:
+            stats = savestats()
+        self.stats = stats
+        if fname is None or hasattr(fname, 'write'):
+            return self._save_memory(fname, headeronly, resume)
+        if headeronly:
+            self._save_header(fname)
+            stats.done()
+            return
+
+        part = fname + '.part'
+        progname = part + '.json'
+        ncfile4 = None
         try:
-            sh.rm(fname)
-        except:
-            pass
+            progress = self._progress(part, progname) if resume else None
+            if progress is not None:
+                ncfile4 = Dataset(part, 'a')
+            else:
+                progress = {}
+                if os.path.exists(progname):
+                    os.remove(progname)
+                ncfile4 = Dataset(part, 'w', clobber=True, format=self._saveformat())
+            self._save_data(ncfile4, part, passthrough, workers, resume, progname, progress)
+        except BaseException:
+            if ncfile4 is not None and ncfile4.isopen():
+                ncfile4.close()
+            if not resume and os.path.exists(part):
+                os.remove(part)
+            raise
+        os.replace(part, fname)
+        if os.path.exists(progname):
+            os.remove(progname)
+        replaced = [ds for ds in self.ifiles
+                    if os.path.abspath(ds.filepath()) == os.path.abspath(fname)]
+        if replaced:
+            # Source was replaced by the saved file, its data are read by
+            # path (memory map, raw chunks, workers), so start over from the new file
+            replaced[0].close()
+            self._reopen(fname)
+        stats.done()
+
+    # Attributes, that control the save, kept by `_reopen`
+    _settings = ('nchunk', 'max_memory', 'prefetch', 'sync_bytes', 'sync_variables',
+                 'rechunk', 'format', 'compression', 'stats')
+
+    def _reopen(self, fname):
+        '''Initialize the ncfile from the saved file, that replaced the source.'''
+        settings = dict((name, getattr(self, name)) for name in self._settings)
+        self.__init__(Dataset(fname))
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+    def _save_memory(self, fileobj, headeronly, resume):
+        '''Save the file to memory, return its content or write it to `fileobj`.'''
+        if headeronly or resume:
+            raise ValueError('headeronly and resumable saves need the file name')
+        ncfile4 = Dataset(getattr(fileobj, 'name', 'memory.nc'), 'w', format=self._saveformat(),
+                          memory=self._nbytes())
+        try:
+            memory = self._save_data(ncfile4, None, False, None, False, None, {})
+        except BaseException:
+            if ncfile4.isopen():
+                ncfile4.close()
+            raise
+        self.stats.done()
+        if fileobj is None:
+            return bytes(memory)
+        fileobj.write(memory)
+
+    def _nbytes(self):
+        '''Approximate size of the data of the saved file in bytes.'''
+        nbytes = 0
+        for perem in self.variab.values():
+            datatype = perem['datatype']
+            itemsize = datatype.itemsize if isinstance(datatype, np.dtype) and datatype.itemsize else 8
+            nbytes += itemsize * int(np.prod([self.dims[dim]['size'] for dim in perem['dimensions']
+                                              if dim in self.dims]))
+        return nbytes
+
+    def _saveformat(self):
+        '''Format of the saved file.'''
+        return self.format or 'NETCDF4_CLASSIC'
+
+    def _progress_key(self):
+        '''Description of the save, that should be the same to resume it.'''
+        key = OrderedDict()
+        key['sources'] = [[fl.filepath(), os.path.getsize(fl.filepath()), os.path.getmtime(fl.filepath())]
+                          for fl in self.ifiles]
+        key['format'] = self._saveformat()
+        key['compression'] = str(self.compression)
+        key['max_memory'] = parse_size(self.max_memory)
+        key['records'] = [self.nchunk, self.istart, self.istop]
+        key['dims'] = [[dim['name'], dim['size'], dim['isunlimited']] for dim in self.dims.values()]
+        key['selection'] = [[dim, indexes.start, indexes.stop, indexes.step]
+                            for dim, indexes in self.selection.items()]
+        key['variables'] = [[vari, list(perem['dimensions']), str(perem['datatype']), self.status(vari)]
+                            for vari, perem in self.variab.items()]
+        # same types as after loading from JSON
+        return json.loads(json.dumps(key))
+
+    def _progress(self, part, progname):
+        '''Progress of the previous save to `part`, None if it can't be resumed.'''
+        if not (os.path.exists(part) and os.path.exists(progname)):
+            return None
+        try:
+            with open(progname) as infile:
+                progress = json.load(infile)
+            Dataset(part).close()
+        except (OSError, ValueError):
+            # the file was not flushed completely
+            return None
+        if progress.get('key') != self._progress_key():
+            return None
+        return progress
+
+    def _save_data(self, ncfile4, fname, passthrough, workers, resume, progname, progress):
+        '''Write the header and the data to the open `ncfile4` (the file `fname`).
+
+        If `progress` of the previous save is given, `ncfile4` is its file,
+        variables, that are done, are skipped and the rest are continued.
+        Returns the result of `ncfile4.close()`, the content of in-memory file.
+        '''
+        stats = self.stats
+        hdf5 = ncfile4.data_model.startswith('NETCDF4')
+        resumed = bool(progress)
+
+        if not resumed:
+            # Create dimensions
+            for dim in self.dims.values():
+                #print(dim)
+                if dim["isunlimited"]:
+                    ncfile4.createDimension(dim['name'],None)
+                else:
+                    ncfile4.createDimension(dim['name'],dim['size'])
 
-        ncfile4 = Dataset(fname,'w',clobber=False,format='NETCDF4_CLASSIC')
+            # Global attributes are written with the rest of the header, before the data
+            for gatt in self.gattrs:
+                setattr(ncfile4, gatt, self.gattrs[gatt])
 
-        # Create dimensions
-        for dim in self.dims.values():
-            #print(dim)
-            if dim["isunlimited"]:
-                ncfile4.createDimension(dim['name'],None)
-                if self.istop == -1: self.istop=dim['size']
-            else:
-                ncfile4.createDimension(dim['name'],dim['size'])
+        sync_bytes, sync_variables = self.sync_bytes, self.sync_variables
+        if resume and sync_bytes is None and sync_variables is None:
+            sync_bytes, sync_variables = _RESUME_SYNC, 1
+        checkpoint = _checkpoints(ncfile4, stats, sync_bytes, sync_variables,
+                                  progname if resume else None, self._progress_key(),
+                                  progress.get('done'), progress.get('slabs'))
+        done = set(checkpoint.done)
 
-        # Loop over variables
-        for vari in self.variab:
-            #print vari
-            perem  = self.variab[vari]
-
-            var = ncfile4.createVariable(vari,
-                                         perem['datatype'],
-                                         perem['dimensions'], \
-                                         fill_value=perem['FillValue'],\
-                                         complevel=1)
-
-            #attdict = perem['data'].__dict__
-            #if '_FillValue' in attdict: del attdict['_FillValue']
-            var.setncatts(perem['attributes'])
-
-            # Zero size string variables are loaded as masked constants by netCDF4 (e.g. rotated_pole)
-            # this workaround seems to solve the problem with not beeing able to
-            # save this masked constant to netCDF4 variables
-            # Error "Cannot set fill value of string with array of dtype "float64".
-            if perem['datatype'].char in 'SU':
-                if type(perem['data'][:]) == np.ma.core.MaskedConstant :
-                    perem['data'] = stringtoarr('',0)
-
-            if perem['hasunlimdim']: # has an unlim dim, loop over unlim dim index.
-                # range to copy
-                if self.nchunk:
-                    start = self.istart; stop = self.istop; step = self.nchunk
-                    if step < 1: step = 1
-                    for n in range(start, stop, step):
-                        nmax = n+step
-                        if nmax > self.istop: nmax=self.istop
-                        idata = perem['data'][n:nmax]
-                        var[n-self.istart:nmax-self.istart] = idata
-                else:
-                    idata = perem['data'][:]
-                    var[0:len(unlimdim)] = idata
+        if workers is not None and workers > 1 and h5py is None:
+            raise ImportError('h5py is required for the parallel save')
 
+        if passthrough and hdf5:
+            h5src = self._h5source()
+        else:
+            h5src = None
+        passed = OrderedDict()
+        pool = None
+        staged = OrderedDict()
 
-            else: # no unlim dim or 1-d variable, just copy all data at once.
-                if perem['data'].shape != ():
-                    idata = perem['data'][:]
-                    var[:] = idata
+        # Loop over variables
+        reader = None
+        try:
+            for vari in self.variab:
+                #print vari
+                perem  = self.variab[vari]
+                if vari in done:
+                    stats.done_variable(vari, 'resumed')
+                    continue
+
+                if 'packing' in perem:
+                    start = time.time()
+                    self._pack(vari, perem)
+                    stats.add(vari, 'pack', time.time() - start)
+
+                source = self._passthrough_source(h5src, vari, perem)
+                start = time.time()
+                if vari in ncfile4.variables:
+                    # created by the interrupted save
+                    var = ncfile4.variables[vari]
                 else:
-                    var[:] = perem['data']
+                    var = self._create_var(ncfile4, vari, perem)
+                stats.add(vari, 'create', time.time() - start)
+                if source is not None:
+                    # data are copied as raw chunks after the file is closed
+                    passed[vari] = source
+                    continue
+
+                if workers is not None and workers > 1 and hdf5 and self._stageable(vari, perem, var):
+                    if pool is None:
+                        pool, stagedir = self._start_workers(fname, workers)
+                    stage = os.path.join(stagedir, '{}.nc'.format(len(staged)))
+                    staged[vari] = pool.submit(_stage_variable, vari, stage, var.chunking())
+                    continue
+
+                # Zero size string variables are loaded as masked constants by netCDF4 (e.g. rotated_pole)
+                # this workaround seems to solve the problem with not beeing able to
+                # save this masked constant to netCDF4 variables
+                # Error "Cannot set fill value of string with array of dtype "float64".
+                if perem['datatype'].char in 'SU' and isinstance(perem['data'], (Variable, _concatvar)):
+                    if type(perem['data'][:]) == np.ma.core.MaskedConstant :
+                        perem['data'] = stringtoarr('',0)
+
+                status = self.status(vari)
+                if status in ('added', 'redataed') and _inmemory(perem['data']):
+                    # new values are already in memory, no need to go through them in slabs
+                    self._write_array(var, perem)
+                    method = 'array'
+                else:
+                    prefetch = self.prefetch and self._fromfile(perem)
+                    if prefetch and reader is None:
+                        reader = _prefetcher(self._portable(), self.prefetch,
+                                             parse_size(self.max_memory))
+                    self._copy_data(var, perem, reader if prefetch else None, checkpoint)
+                    method = 'copy'
+
+                stats.done_variable(vari, method)
+                checkpoint.variable(vari)
+        except BaseException:
+            if reader is not None:
+                reader.terminate()
+            raise
+        if reader is not None:
+            reader.close()
+
+        start = time.time()
+        memory = ncfile4.close()
+        stats.add(None, 'close', time.time() - start)
+
+        if h5src is not None:
+            try:
+                if passed:
+                    self._copy_chunks(fname, OrderedDict((vari, h5src[source])
+                                                         for vari, source in passed.items()))
+            finally:
+                h5src.close()
 
-            ncfile4.sync() # flush data to disk
+        if pool is not None:
+            try:
+                for vari, future in staged.items():
+                    start = time.time()
+                    stage, precision = future.result()
+                    stats.add(vari, 'workers', time.time() - start)
+                    if precision is not None:
+                        self.journal[vari]['precision'] = precision
+                    h5stage = h5py.File(stage, 'r')
+                    self._copy_chunks(fname, {vari: h5stage[vari]}, 'workers')
+                    h5stage.close()
+            finally:
+                pool.shutdown()
+                shutil.rmtree(stagedir)
+        return memory
+
+    def _chunking(self, vari, perem):
+        '''Chunking of the variable in the saved file.'''
+        if self.rechunk is not None:
+            return self.rechunk(vari, perem)
+        return perem.get('chunking')
+
+    def _filters(self, vari, perem):
+        '''Compression filters of the variable in the saved file.'''
+        if self.compression is None:
+            return perem.get('filters')
+        if vari in self.journal and 'refiltered' in self.journal[vari]['changes']:
+            return perem.get('filters')
+        if isinstance(self.compression, str):
+            if self.compression not in COMPRESSION:
+                raise ValueError('there is no compression preset {}'.format(self.compression))
+            return COMPRESSION[self.compression]
+        return self.compression
+
+    def _create_var(self, ncfile4, vari, perem, chunking=None):
+        '''Create the variable in the netCDF file and set its attributes.
+
+        Chunking, filters and endianness are taken from the variable
+        dictionary, `chunking` overrides the chunking.
+        '''
+        if chunking is None:
+            chunking = self._chunking(vari, perem)
+        kwargs = _storage_kwargs(chunking, self._filters(vari, perem), perem.get('endian'),
+                                 perem['dimensions'], self.dims, ncfile4.data_model)
+        datatype = perem['datatype']
+        if 'endian' in kwargs and isinstance(datatype, np.dtype) and datatype.byteorder != '|':
+            # byte order of the data type should agree with endian
+            datatype = datatype.newbyteorder({'big': '>', 'little': '<'}.get(kwargs['endian'], '='))
+        fill_value = perem['FillValue']
+        attributes = perem['attributes']
+        packing = perem.get('packing')
+        if packing is not None and 'scale_factor' in packing:
+            fill_value = packing['FillValue']
+            attributes = OrderedDict(attributes)
+            attributes['scale_factor'] = packing['scale_factor']
+            attributes['add_offset'] = packing['add_offset']
+            # valid range and missing value of the source are in physical units
+            for attr in ('valid_min', 'valid_max', 'valid_range'):
+                if attr in attributes:
+                    attributes[attr] = _packvalue(attributes[attr], packing, perem['datatype'])
+            if 'missing_value' in attributes:
+                attributes['missing_value'] = packing['FillValue']
+        elif vari in self.journal and 'retyped' in self.journal[vari]['changes'] and \
+                np.dtype(perem['datatype']).kind in 'iuf':
+            for name, value in (('FillValue', fill_value),
+                                ('missing_value', attributes.get('missing_value'))):
+                if value is not None and not _fits(value, np.dtype(perem['datatype'])):
+                    raise ValueError('{} {} of {} does not fit in {}'.format(
+                        name, value, vari, perem['datatype']))
+        var = ncfile4.createVariable(vari,
+                                     datatype,
+                                     perem['dimensions'], \
+                                     fill_value=fill_value,\
+                                     **kwargs)
+
+        #attdict = perem['data'].__dict__
+        #if '_FillValue' in attdict: del attdict['_FillValue']
+        var.setncatts(attributes)
+        return var
+
+    def _stageable(self, vari, perem, var):
+        '''True if the variable can be written by a worker of the parallel save.'''
+        if not isinstance(perem['data'], Variable) or var.chunking() == 'contiguous':
+            return False
+        if perem['datatype'].char in 'SUO' or 'packing' in perem:
+            return False
+        if vari in self.dims and perem['dimensions'] != (vari,):
+            return False
+        try:
+            perem['data'].group().filepath()
+        except ValueError:
+            # in-memory dataset
+            return False
+        return True
+
+    def _start_workers(self, fname, workers):
+        '''Start processes for the parallel save and create directory for their files.'''
+        stagedir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                    prefix='.fixnc')
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(self._portable(),))
+        return pool, stagedir
+
+    def _portable(self):
+        '''Copy of the ncfile for other processes, only with variables they may have to read.'''
+        nc = object.__new__(self.__class__)
+        nc.__dict__.update(self.__dict__)
+        nc.variab = OrderedDict((vari, perem) for vari, perem in self.variab.items()
+                                if isinstance(perem['data'], (Variable, _concatvar)))
+        nc.edits = []
+        # statistics of the other processes are not collected
+        nc.stats = savestats(slabs=False)
+        return nc
+
+    def _fromfile(self, perem):
+        '''True if the data of the variable are read from files, that can be reopened.'''
+        data = perem['data']
+        if not isinstance(data, (Variable, _concatvar)):
+            return False
+        try:
+            for src in (data.variables if isinstance(data, _concatvar) else [data]):
+                src.group().filepath()
+        except ValueError:
+            # in-memory dataset
+            return False
+        return True
+
+    def _stage(self, vari, fname, chunking):
+        '''Write the variable to a separate file, to be copied to the saved file as raw chunks.'''
+        perem = self.variab[vari]
+        ncfile4 = Dataset(fname, 'w', format='NETCDF4')
+        for dim in perem['dimensions']:
+            if self.dims[dim]['isunlimited']:
+                ncfile4.createDimension(dim, None)
+            else:
+                ncfile4.createDimension(dim, self.dims[dim]['size'])
+        var = self._create_var(ncfile4, vari, perem, chunking)
+        self._copy_data(var, perem)
+        ncfile4.close()
+        return fname, self.journal.get(vari, {}).get('precision')
+
+    def __getstate__(self):
+        # netCDF objects can't be pickled, they are reopened from the files
+        state = self.__dict__.copy()
+        for key in ('ifile', 'ifiles', 'variab', 'edits'):
+            state[key] = _toref(state[key])
+        return state
+
+    def __setstate__(self, state):
+        cache = {}
+        for key in ('ifile', 'ifiles', 'variab', 'edits'):
+            state[key] = _fromref(state[key], cache)
+        self.__dict__.update(state)
+
+    def _h5source(self):
+        '''Open the source file with h5py, if raw chunks can be copied from it.'''
+        if h5py is None or not hasattr(h5py.h5d.DatasetID, 'get_chunk_info'):
+            return None
+        if not self.ifile.data_model.startswith('NETCDF4'):
+            return None
+        return h5py.File(self.ifile.filepath(), 'r')
+
+    def _passthrough_source(self, h5src, vari, perem):
+        '''Name of the HDF5 dataset, that can be copied to the variable as raw chunks.
+
+        Returns None if the data of the variable have to be copied through netCDF.
+        '''
+        if h5src is None or self.status(vari) not in ('untouched', 'metadata'):
+            return None
+        srcvar = perem['data']
+        if not isinstance(srcvar, Variable) or srcvar.group() is not self.ifile:
+            return None
+        if srcvar.chunking() == 'contiguous' or perem['datatype'] != srcvar.dtype:
+            return None
+        if perem['datatype'].char in 'SUO':
+            return None
+        if not self._sameencoding(perem, srcvar):
+            return None
+        # data should be stored in the same way
+        if self._chunking(vari, perem) != srcvar.chunking():
+            return None
+        if _normfilters(self._filters(vari, perem)) != srcvar.filters():
+            return None
+        if perem.get('endian') != srcvar.endian():
+            return None
+        # sizes of the dimensions and the range along unlimited dimension should be the same
+        shape = tuple(self.dims[dim]['size'] for dim in perem['dimensions'])
+        if shape != srcvar.shape:
+            return None
+        if perem['hasunlimdim'] and (self.istart != 0 or self.istop not in (-1, srcvar.shape[0])):
+            return None
+        # HDF5 datasets of variables named as dimensions, but that are not
+        # coordinate variables, have different names
+        if vari in self.dims and perem['dimensions'] != (vari,):
+            return None
+        if srcvar.name in self.ifile.dimensions and srcvar.dimensions != (srcvar.name,):
+            return None
+        if srcvar.name not in h5src or h5src[srcvar.name].chunks != tuple(srcvar.chunking()):
+            return None
+        return srcvar.name
+
+    def _copy_chunks(self, fname, sources, method='passthrough'):
+        '''Copy raw chunks from HDF5 datasets in `sources` to the variables of the saved file.
+
+        Variables, that can't be copied this way, are copied through netCDF.
+        '''
+        failed = []
+        h5dst = h5py.File(fname, 'r+')
+        for vari, src in sources.items():
+            dst = h5dst.get(vari)
+            if (dst is None or dst.chunks != src.chunks or dst.dtype != src.dtype
+                    or _h5filters(dst) != _h5filters(src)):
+                failed.append(vari)
+                continue
+            start = time.time()
+            nbytes = 0
+            if dst.shape != src.shape:
+                dst.resize(src.shape)
+            for i in range(src.id.get_num_chunks()):
+                offset = src.id.get_chunk_info(i).chunk_offset
+                filter_mask, chunk = src.id.read_direct_chunk(offset)
+                dst.id.write_direct_chunk(offset, chunk, filter_mask)
+                nbytes += len(chunk)
+            self.stats.add(vari, method, time.time() - start, read=nbytes, written=nbytes)
+            self.stats.done_variable(vari, method)
+        h5dst.close()
+
+        if failed:
+            ncfile4 = Dataset(fname, 'a')
+            for vari in failed:
+                self._copy_data(ncfile4.variables[vari], self.variab[vari])
+                self.stats.done_variable(vari, 'copy')
+            ncfile4.close()
+
+    def _write_array(self, var, perem):
+        '''Write data of the variable, that are in memory, at once.'''
+        data = perem['data']
+        convert = self._converter(var, perem)
+        if data.shape == ():
+            key = out = Ellipsis
+        else:
+            ranges = self._ranges(perem, data.shape)
+            out = tuple(slice(0, len(indexes)) for indexes in ranges)
+            key = _srckey(ranges, out)
+        start = time.time()
+        values = convert(data[key])
+        converted = time.time()
+        var[out] = values
+        self.stats.slab(var.name, out, 0., converted - start, time.time() - converted,
+                        0, np.asarray(values).nbytes)
+
+    def _pack(self, vari, perem):
+        '''Compute scale_factor, add_offset and FillValue of the variable packed on save.
+
+        Bounds of the values, if not given, are computed in slabs.
+        '''
+        packing = perem['packing']
+        bounds = packing['bounds']
+        if bounds is None:
+            data, switched = self._source(vari, perem)
+            low, high = np.inf, -np.inf
+            for dst, src in self._slab_keys(None, perem, data):
+                values = np.ma.masked_invalid(data[src]).compressed()
+                if values.size:
+                    low, high = min(low, values.min()), max(high, values.max())
+            if low > high:
+                # no valid values
+                low = high = 0
+            bounds = (low, high)
+
+        dtype = perem['datatype']
+        info = np.iinfo(dtype)
+        # one value is left for the FillValue
+        if dtype.kind == 'i':
+            steps = int(info.max) - int(info.min) - 1
+            fill = info.min
+        else:
+            steps = int(info.max) - 1
+            fill = info.max
+        low, high = float(bounds[0]), float(bounds[1])
+        scale = (high - low) / steps if high > low else 1.0
+        # low is packed to the smallest value
+        offset = low - (int(fill) + 1 if dtype.kind == 'i' else 0) * scale
+
+        packing['scale_factor'] = np.float64(scale)
+        packing['add_offset'] = np.float64(offset)
+        packing['FillValue'] = dtype.type(fill)
+        packing['range'] = (low, high)
+
+    def _converter(self, var, perem):
+        '''Function, that converts slabs to the data type of the variable.
+
+        Values are checked to fit in the data type, maximum conversion error
+        is stored in the journal. For variables without changed data
+        type the slabs are returned as they are.
+        '''
+        dtype = perem['datatype']
+        packing = perem.get('packing')
+        vari = var.name
+        # new data can be retyped too, status of the variable is 'added' or 'redataed' then
+        retyped = vari in self.journal and 'retyped' in self.journal[vari]['changes']
+        if not retyped or dtype.kind not in 'iuf':
+            return lambda slab: slab
+        precision = OrderedDict([('max_error', 0.0)])
+        if packing is not None:
+            scale = float(packing['scale_factor'])
+            offset = float(packing['add_offset'])
+            precision['bounds'] = packing['range']
+            precision['scale_factor'] = scale
+            precision['add_offset'] = offset
+            # values are packed here, not by netCDF4
+            var.set_auto_maskandscale(False)
+        self.journal[vari]['precision'] = precision
+        if dtype.kind == 'f':
+            low, high = -np.finfo(dtype).max, np.finfo(dtype).max
+        else:
+            low, high = np.iinfo(dtype).min, np.iinfo(dtype).max
+
+        def convert(slab):
+            values = np.ma.masked_invalid(np.ma.asarray(slab, dtype=np.float64))
+            if packing is not None:
+                values = np.ma.round((values - offset) / scale)
+                if np.ma.count(values) and (values.min() < low + (dtype.kind == 'i') or values.max() > high - (dtype.kind == 'u')):
+                    raise ValueError('values of {} are out of bounds {} of packing'.format(
+                        vari, packing['range']))
+                error = np.ma.abs(values * scale + offset - np.ma.asarray(slab, dtype=np.float64))
+                converted = values.filled(packing['FillValue']).astype(dtype)
+            else:
+                if np.ma.count(values) and (values.min() < low or values.max() > high):
+                    raise ValueError('values of {} do not fit in {}'.format(vari, dtype))
+                if dtype.kind != 'f' and np.ma.count_masked(values) > np.ma.count_masked(slab):
+                    raise ValueError('NaN or infinite values of {} can not be converted to {}'.format(vari, dtype))
+                converted = np.ma.asarray(slab).astype(dtype)
+                error = np.ma.abs(np.ma.asarray(converted, dtype=np.float64) - values)
+            if np.ma.count(error):
+                precision['max_error'] = max(precision['max_error'], float(error.max()))
+            return converted
+        return convert
+
+    def _copy_data(self, var, perem, reader=None, checkpoint=None):
+        '''Copy data of the variable in slabs, that fit in `max_memory`.
+
+        Slabs are taken along the unlimited dimension (`nchunk` records) and
+        split further if they are still too large. Data of the variables
+        copied as they are (see `_rawcopy`) are read and written as raw
+        values, without masking and scaling. If `reader` (`_prefetcher`)
+        is given, slabs are read by it, while the previous are written.
+        Every written slab is passed to the `checkpoint` (`_checkpoints`),
+        slabs, that it has already, are skipped.
+        '''
+        if self._rawcopy(var.name, perem):
+            var.set_auto_maskandscale(False)
+        data, switched = self._source(var.name, perem)
+        try:
+            slabs = self._slab_keys(var, perem, data)
+            if checkpoint is not None:
+                slabs = itertools.islice(slabs, checkpoint.slabs.get(var.name, 0), None)
+            convert = self._converter(var, perem)
+            if reader is not None:
+                slabs = list(slabs)
+                reader.read(var.name, [src for dst, src in slabs])
+            stats = self.stats
+            for dst, src in slabs:
+                start = time.time()
+                values = data[src] if reader is None else reader.get()
+                read = time.time()
+                converted = convert(values)
+                convert_end = time.time()
+                var[dst] = converted
+                stats.slab(var.name, dst, read - start, convert_end - read, time.time() - convert_end,
+                           np.asarray(values).nbytes, np.asarray(converted).nbytes)
+                if checkpoint is not None:
+                    checkpoint.slab(var.name)
+        finally:
+            # source variables are read as before
+            for src, mask, scale in switched:
+                src.set_auto_mask(mask)
+                src.set_auto_scale(scale)
+
+    def _source(self, vari, perem):
+        '''Data of the variable to copy and the list of (source variable, mask, scale)
+        for the source variables with masking and scaling switched off.'''
+        data = self._array(perem)
+        switched = []
+        if self._rawcopy(vari, perem):
+            mapped = self._mapped(data)
+            if mapped is not None:
+                data = mapped
+            else:
+                for src in (data.variables if isinstance(data, _concatvar) else [data]):
+                    switched.append((src, src.mask, src.scale))
+                    src.set_auto_maskandscale(False)
+        return data, switched
+
+    def _array(self, perem):
+        '''Data of the variable as array-like, data computed on save are wrapped in `_computed`.'''
+        data = perem['data']
+        if isinstance(data, derived):
+            inputs = [self._array(self.variab[name]) for name in data.variables]
+            func = lambda key: data.func(*[values[key] for values in inputs])
+        elif callable(data) and not hasattr(data, 'shape'):
+            func = data
+        else:
+            return data
+        shape = tuple(self.dims[dim]['size'] for dim in perem['dimensions'])
+        return _computed(func, shape, perem['datatype'])
+
+    def _slab_keys(self, var, perem, data):
+        '''Generate (slab of `var`, slab of `data`) pairs, to copy the data slab by slab.'''
+        budget = parse_size(self.max_memory)
+        itemsize = max(perem['datatype'].itemsize, getattr(data, 'dtype', perem['datatype']).itemsize)
+        if data.shape == ():
+            yield Ellipsis, Ellipsis
+            return
+        # indexes to copy and shape of the result
+        ranges = self._ranges(perem, data.shape)
+        shape = tuple(len(indexes) for indexes in ranges)
+        if perem['hasunlimdim']: # has an unlim dim, loop over unlim dim index.
+            records = ranges[0]
+            if self.nchunk == 'auto':
+                recsize = itemsize * int(np.prod(shape[1:], dtype=np.int64))
+                step = _nrecords(recsize, budget, (_chunklen(data), _chunklen(var)))
+            elif self.nchunk:
+                step = self.nchunk
+                if step < 1: step = 1
+            else:
+                step = max(len(records), 1)
+            n = 0
+            while n < len(records):
+                # slabs start at multiples of step in the source, to be aligned with chunks
+                boundary = (records[n] // step + 1) * step
+                nmax = min(-(-(boundary - records.start) // records.step), len(records))
+                for slab in _slabs((nmax-n,) + shape[1:], itemsize, budget):
+                    dst = (slice(n+slab[0].start, n+slab[0].stop),) + slab[1:]
+                    yield dst, _srckey(ranges, dst)
+                n = nmax
+
+        else: # no unlim dim or 1-d variable, copy slab by slab.
+            for slab in _slabs(shape, itemsize, budget):
+                yield slab, _srckey(ranges, slab)
+
+    def _rawcopy(self, vari, perem):
+        '''True if the data of the variable can be copied as raw values.
+
+        This is the case for the variables from the source files without
+        changes of the data, data type, fill value and attributes of packing
+        and masking (see `_ENCODING_ATTRS`). Packed values and fill values
+        are the same in the saved file then.
+        '''
+        data = perem['data']
+        if not isinstance(data, (Variable, _concatvar)):
+            return False
+        if self.status(vari) not in ('untouched', 'metadata'):
+            return False
+        if data.dtype != perem['datatype'] or perem['datatype'].char in 'SUO':
+            return False
+        first = data.variables[0] if isinstance(data, _concatvar) else data
+        return self._sameencoding(perem, first)
+
+    def _sameencoding(self, perem, srcvar):
+        '''True if the fill value and the attributes, that define packing and
+        masking of the values, are the same as of the source variable.'''
+        srcattrs = srcvar.__dict__
+        if not _samevalue(perem['FillValue'], srcattrs.get('_FillValue')):
+            return False
+        attributes = perem['attributes']
+        for attr in _ENCODING_ATTRS:
+            if (attr in attributes) != (attr in srcattrs):
+                return False
+            if attr in attributes and not _samevalue(attributes[attr], srcattrs[attr]):
+                return False
+        return True
+
+    def _mapped(self, data):
+        '''Memory mapped data of the netCDF classic variable.
+
+        Returns numpy view of the raw values in the file or None, if the
+        variable is not from a netCDF classic file.
+        '''
+        if not isinstance(data, Variable) or 0 in data.shape:
+            return None
+        ds = data.group()
+        if not ds.data_model.startswith('NETCDF3'):
+            return None
+        try:
+            path = ds.filepath()
+        except ValueError:
+            # in-memory dataset
+            return None
+        if path not in self._layouts:
+            self._layouts[path] = _cdf_layout(path)
+        variables, recsize = self._layouts[path]
+        begin, isrec = variables[data.name]
+
+        # data are big endian, records of the record variables are interleaved
+        dtype = data.dtype.newbyteorder('>')
+        strides = []
+        step = dtype.itemsize
+        for n in reversed(data.shape):
+            strides.insert(0, step)
+            step *= n
+        if isrec:
+            strides[0] = recsize
+        return np.ndarray(data.shape, dtype, buffer=np.memmap(path, dtype='u1', mode='r'),
+                          offset=begin, strides=strides)
+
+    def save_recipe(self, fname):
+        '''Save edits of the ncfile as a recipe, that can be applied to other files.
+
+        See `dump_recipe`. Variables of the source file, used as data
+        in the edits, are referred by name, so the recipe uses variables
+        of the file it is applied to.
 
-        #gattrs = self.ifile.ncattrs()
-        for gatt in self.gattrs:
-            setattr(ncfile4, gatt, self.gattrs[gatt])
+        Parameters
+        ----------
+        fname : str
+            Name of the JSON or YAML (.yaml, .yml) file.
+        '''
+        dump_recipe(self.edits, fname, self.ifile)
 
+    def _save_header(self, fname):
+        '''Apply metadata edits to a copy of the source file, or to the source file itself.
+        '''
+        if not self.headeronly:
+            raise ValueError('edits change the structure or the data of the file, use save without headeronly')
+
+        source = self.ifile.filepath()
+        inplace = os.path.abspath(fname) == os.path.abspath(source)
+        if inplace:
+            # netCDF library can't open the file for writing while it is open for reading
+            self.ifile.close()
+            target = fname
+        else:
+            # the copy is edited and renamed, so fname is never left half edited
+            target = fname + '.part'
+            _copyfile(source, target)
 
-        ncfile4.close()
+        ncfile4 = None
+        try:
+            ncfile4 = Dataset(target, 'r+')
+            for name, args in self.edits:
+                if name == 'rename_dim':
+                    ncfile4.renameDimension(args[0], args[1])
+                elif name == 'rename_var':
+                    ncfile4.renameVariable(args[0], args[1])
+                elif name == 'rename_attr':
+                    if args[1] in ncfile4.variables[args[0]].ncattrs():
+                        ncfile4.variables[args[0]].renameAttribute(args[1], args[2])
+                elif name == 'rename_gattr':
+                    if args[0] in ncfile4.ncattrs():
+                        ncfile4.renameAttribute(args[0], args[1])
+                elif name in ('change_attr', 'add_attr'):
+                    ncfile4.variables[args[0]].setncattr(args[1], args[2])
+                elif name in ('change_gattr', 'add_gattr'):
+                    ncfile4.setncattr(args[0], args[1])
+                elif name == 'del_attr':
+                    ncfile4.variables[args[0]].delncattr(args[1])
+            ncfile4.close()
+            if not inplace:
+                os.replace(target, fname)
+        except BaseException:
+            if ncfile4 is not None and ncfile4.isopen():
+                ncfile4.close()
+            if not inplace and os.path.exists(target):
+                os.remove(target)
+            raise
+        finally:
+            if inplace:
+                # Data of the variables point to the closed file, start over from the updated
+                # one (if an edit failed, edits before it are already applied)
+                self._reopen(fname)
 
     def __repr__(self):
         '''
@@ -603,17 +2777,626 @@ class ncfile(object):
                                                ', '.join(self.variab[key]['dimensions'])))
             for attr in self.variab[key]['attributes'].items():
                 svars.append("\t   {}: {}\n".format(attr[0], attr[1]))
-            if self.variab[key]['FillValue']:
-                svars.append("\t   FillValue: {}\n".format(attr[0], str(self.variab[key]['FillValue'])))
+            if self.variab[key]['FillValue'] is not None:
+                svars.append("\t   FillValue: {}\n".format(str(self.variab[key]['FillValue'])))
         svars = ''.join(svars)
         sinfo.append(svars)
         sgattr = []
         for attr in self.gattrs:
-            print(attr)
             sgattr.append('\t {}:{}\n'.format(attr , self.gattrs[attr]))
         sgattr = ''.join(sgattr)
         sinfo.append(sgattr)
-        print(sinfo)
         return '\n'.join(sinfo)
 
+    def diff(self, other, partial=False):
+        '''Differences of the header from the header of the other ncfile,
+        file or template, see `diff`.'''
+        return diff(self, other, partial)
+
+
+# Attributes, that define how the values are packed and masked by netCDF4
+_ENCODING_ATTRS = ('scale_factor', 'add_offset', 'missing_value', 'valid_min',
+                   'valid_max', 'valid_range', '_Unsigned')
+
+# Methods of ncfile, that can be used in recipes
+EDITS = ('rename_dim', 'rename_dim_invar', 'rename_attr', 'rename_gattr',
+         'change_attr', 'change_gattr', 'change_data', 'change_dtype',
+         'change_chunking', 'change_filters', 'change_endian', 'rename_var',
+         'add_dim', 'add_attr', 'add_gattr', 'add_var', 'del_attr', 'del_var',
+         'reorder_dims', 'reorder_vars', 'isel')
+
+class _sourcevar(object):
+    '''Variable of the source file of the ncfile, the recipe is applied to.'''
+
+    def __init__(self, name):
+        self.name = name
+
+def encode_recipe(recipe, source=None):
+    '''Convert recipe to the structure of lists and dictionaries, that can be stored in JSON.
+
+    numpy arrays, scalars and data types, slices and netCDF variables are
+    stored as dictionaries with '__ndarray__', '__scalar__', '__dtype__',
+    '__slice__' and '__variable__' keys. Other objects, e.g. `derived`,
+    callable or memory mapped data, raise ValueError.
+
+    Parameters
+    ----------
+    recipe : list
+        List of (method name, arguments) edits, like `ncfile.edits`.
+    source : Dataset, optional
+        Variables from this Dataset are stored only by name, and are taken
+        from the source file of the ncfile when the recipe is applied.
+        Other variables are stored with the name of their file.
+
+    Returns
+    -------
+    list
+    '''
+    return [[edit[0], _encode(edit[1], source)] for edit in recipe]
+
+def _encode(obj, source=None):
+    '''Convert `obj` to the structure, that can be stored in JSON (see `encode_recipe`).'''
+    if isinstance(obj, Variable):
+        if source is not None and obj.group() is source:
+            return OrderedDict([('__variable__', obj.name)])
+        ref = _ncref(obj)
+        return OrderedDict([('__variable__', ref.name), ('path', ref.path),
+                            ('group', ref.group)])
+    if isinstance(obj, np.dtype):
+        return OrderedDict([('__dtype__', obj.str)])
+    if isinstance(obj, slice):
+        return OrderedDict([('__slice__', [obj.start, obj.stop, obj.step])])
+    if isinstance(obj, np.memmap) or isinstance(getattr(obj, 'data', None), np.memmap):
+        # e.g. data of load_variable, that may not fit in memory
+        raise ValueError('memory mapped data can not be stored in the recipe')
+    if isinstance(obj, np.ma.MaskedArray):
+        return OrderedDict([('__ndarray__', obj.filled().tolist()), ('dtype', obj.dtype.str),
+                            ('mask', np.ma.getmaskarray(obj).tolist())])
+    if isinstance(obj, np.ndarray):
+        return OrderedDict([('__ndarray__', obj.tolist()), ('dtype', obj.dtype.str)])
+    if isinstance(obj, np.generic):
+        return OrderedDict([('__scalar__', obj.item()), ('dtype', obj.dtype.str)])
+    if isinstance(obj, dict):
+        return OrderedDict((key, _encode(value, source)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_encode(value, source) for value in obj]
+    if obj is None or isinstance(obj, (str, int, float)):
+        return obj
+    # e.g. derived and callable data
+    raise ValueError('{} can not be stored in the recipe'.format(type(obj).__name__))
+
+def decode_recipe(data):
+    '''Convert structure produced by `encode_recipe` back to the recipe.
+
+    Parameters
+    ----------
+    data : list
+
+    Returns
+    -------
+    list
+        List of (method name, arguments) edits.
+    '''
+    return [(edit[0], tuple(_decode(edit[1]))) for edit in data]
+
+def _decode(obj):
+    '''Convert structure produced by `_encode` back.'''
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            array = np.array(obj['__ndarray__'], dtype=obj['dtype'])
+            if 'mask' in obj:
+                array = np.ma.masked_array(array, mask=obj['mask'])
+            return array
+        if '__scalar__' in obj:
+            return np.dtype(obj['dtype']).type(obj['__scalar__'])
+        if '__dtype__' in obj:
+            return np.dtype(obj['__dtype__'])
+        if '__slice__' in obj:
+            return slice(*obj['__slice__'])
+        if '__variable__' in obj:
+            if 'path' in obj:
+                ref = object.__new__(_ncref)
+                ref.name, ref.path, ref.group = obj['__variable__'], obj['path'], obj.get('group', '/')
+                return ref
+            return _sourcevar(obj['__variable__'])
+        return OrderedDict((key, _decode(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_decode(value) for value in obj]
+    return obj
+
+def _plain(obj):
+    '''Replace OrderedDict by dict, for YAML.'''
+    if isinstance(obj, dict):
+        return dict((key, _plain(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_plain(value) for value in obj]
+    return obj
+
+def dump_recipe(recipe, fname, source=None):
+    '''Save the recipe to JSON or YAML file.
+
+    Parameters
+    ----------
+    recipe : list
+        List of (method name, arguments) edits, like `ncfile.edits`.
+    fname : str
+        Name of the file, YAML (requires PyYAML) if it ends with .yaml or .yml,
+        JSON otherwise.
+    source : Dataset, optional
+        See `encode_recipe`.
+    '''
+    data = encode_recipe(recipe, source)
+    with open(fname, 'w') as fl:
+        if fname.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is required to save recipes as YAML')
+            yaml.safe_dump(_plain(data), fl, default_flow_style=None, sort_keys=False)
+        else:
+            json.dump(data, fl, indent=1)
+
+def load_recipe(fname):
+    '''Load the recipe from JSON or YAML file.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the file, YAML (requires PyYAML) if it ends with .yaml or .yml,
+        JSON otherwise.
+
+    Returns
+    -------
+    list
+        List of (method name, arguments) edits, that can be used in `apply_recipe`.
+    '''
+    with open(fname) as fl:
+        if fname.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is required to load recipes from YAML')
+            data = yaml.safe_load(fl)
+        else:
+            data = json.load(fl, object_pairs_hook=OrderedDict)
+    return decode_recipe(data)
+
+def _resolve(obj, nc, cache):
+    '''Replace references to netCDF variables in the recipe arguments by the variables.'''
+    if isinstance(obj, _sourcevar):
+        return nc.ifile.variables[obj.name]
+    if isinstance(obj, _ncref):
+        return obj.open(cache)
+    if isinstance(obj, dict):
+        return obj.__class__((key, _resolve(value, nc, cache)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_resolve(value, nc, cache) for value in obj)
+    return obj
+
+def apply_recipe(nc, recipe):
+    '''Apply edits from the recipe to the ncfile.
+
+    Parameters
+    ----------
+    nc : ncfile
+        ncfile to edit.
+    recipe : list or callable
+        List of edits, every edit is a (method name, arguments) pair, like
+        ('rename_dim', ('X', 'lon')), the same as in `ncfile.edits`, or
+        loaded with `load_recipe`. Method names should be from `EDITS`.
+        Can be also a function, that takes ncfile as the only argument.
+
+    Returns
+    -------
+    ncfile
+        The same ncfile.
+    '''
+    if callable(recipe):
+        recipe(nc)
+        return nc
+    cache = {}
+    for edit in recipe:
+        name, args = edit[0], edit[1]
+        if name not in EDITS:
+            raise ValueError('{} is not an ncfile edit'.format(name))
+        args = _resolve(tuple(args), nc, cache)
+        if name == 'add_var':
+            # the recipe can be applied again, e.g. to other files
+            args = (args[0], _copyvar(args[1])) + tuple(args[2:])
+        getattr(nc, name)(*args)
+    return nc
+
+def fix_file(fname, recipe, output, headeronly=False, **kwargs):
+    '''Apply the recipe to the netCDF file and save the result.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the netCDF file.
+    recipe : list or callable
+        Edits, see `apply_recipe`.
+    output : str
+        Name of the saved file.
+    headeronly : bool
+        Save only the header, see `ncfile.save`.
+    **kwargs
+        Attributes of the ncfile, that control the save (e.g. format, compression).
+
+    Returns
+    -------
+    str
+        Name of the saved file.
+    '''
+    _check_settings(kwargs)
+    fl = Dataset(fname)
+    nc = None
+    try:
+        nc = ncfile(fl)
+        for key, value in kwargs.items():
+            setattr(nc, key, value)
+        apply_recipe(nc, recipe)
+        nc.save(output, headeronly=headeronly)
+    finally:
+        if fl.isopen():
+            fl.close()
+        # in-place header only save reopens the file
+        if nc is not None and nc.ifile.isopen():
+            nc.ifile.close()
+    return output
+
+def _check_settings(kwargs):
+    '''Raise ValueError, if `kwargs` are not the settings of the save (`ncfile._settings`).'''
+    unknown = sorted(set(kwargs) - set(ncfile._settings))
+    if unknown:
+        raise ValueError('unknown settings {}, should be one of {}'.format(
+            ', '.join(unknown), ', '.join(ncfile._settings)))
+
+def _fix_file_safe(fname, recipe, output, headeronly, kwargs):
+    '''Run `fix_file`, return error message instead of raising.'''
+    try:
+        fix_file(fname, recipe, output, headeronly, **kwargs)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+def _output_name(fname, outdir=None, suffix=None):
+    '''Name of the saved file for the batch processing.'''
+    if outdir is None and not suffix:
+        raise ValueError('outdir or suffix should be given, files are not overwritten')
+    root, ext = os.path.splitext(os.path.basename(fname))
+    if suffix:
+        root = root + suffix
+    if outdir is None:
+        outdir = os.path.dirname(fname)
+    output = os.path.join(outdir, root + ext)
+    if os.path.abspath(output) == os.path.abspath(fname):
+        raise ValueError('{} would be overwritten, give other outdir or suffix'.format(fname))
+    return output
+
+def batch(files, recipe, outdir=None, suffix=None, workers=None, headeronly=False,
+          progress=None, **kwargs):
+    '''Apply the same recipe to many files in parallel.
+
+    Every file is processed in a separate process, errors in one file
+    do not stop the processing of the others.
+
+    Parameters
+    ----------
+    files : list or str
+        List of file names or glob pattern, like 'data/*.nc'.
+    recipe : list or callable
+        Edits, see `apply_recipe`. Functions should be defined on the module
+        level, to be sent to the processes.
+    outdir : str, optional
+        Directory for the saved files. By default files are saved next to the originals.
+        The originals are never overwritten, ValueError is raised if a saved file
+        would have the name of its original.
+    suffix : str, optional
+        Added to the names of the saved files, e.g. '_fixed'.
+    workers : int, optional
+        Number of processes, by default number of CPUs. If 1, files are
+        processed in the current process.
+    headeronly : bool
+        Save only the header, see `ncfile.save`.
+    progress : callable, optional
+        Called after every file with (number of processed files, number of files,
+        file name, error message or None).
+    **kwargs
+        Attributes of the ncfile, that control the save (e.g. format, compression).
 
+    Returns
+    -------
+    list
+        (file name, saved file name, error message or None) for every file,
+        in the order of `files`.
+    '''
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    _check_settings(kwargs)
+    outputs = [_output_name(fname, outdir, suffix) for fname in files]
+    if outdir is not None and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    errors = {}
+    if workers == 1 or len(files) <= 1:
+        for i, (fname, output) in enumerate(zip(files, outputs)):
+            errors[fname] = _fix_file_safe(fname, recipe, output, headeronly, kwargs)
+            if progress is not None:
+                progress(i + 1, len(files), fname, errors[fname])
+    else:
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            futures = dict((pool.submit(_fix_file_safe, fname, recipe, output, headeronly, kwargs), fname)
+                           for fname, output in zip(files, outputs))
+            for i, future in enumerate(as_completed(futures)):
+                fname = futures[future]
+                try:
+                    errors[fname] = future.result()
+                except Exception:
+                    # worker process died
+                    errors[fname] = traceback.format_exc()
+                if progress is not None:
+                    progress(i + 1, len(files), fname, errors[fname])
+        finally:
+            pool.shutdown()
+    return [(fname, output, errors[fname]) for fname, output in zip(files, outputs)]
+
+def _typename(datatype):
+    '''Name of the data type, like 'float32' or 'str'.'''
+    if isinstance(datatype, np.dtype):
+        return datatype.name
+    return getattr(datatype, '__name__', str(datatype))
+
+def header(obj):
+    '''Header of the file: format, dimensions, variables and attributes.
+
+    The data of the variables are not read.
+
+    Parameters
+    ----------
+    obj : ncfile, Dataset, str or dict
+        ncfile (the header, that is saved, without attributes added by
+        packing on save; the format is that of the source file, if the
+        `format` of the ncfile is not set), netCDF file, name of the netCDF file, or of the
+        JSON or YAML template (see `dump_header`), or the header itself.
+
+    Returns
+    -------
+    OrderedDict
+        'format', 'dimensions' ({name: {'size', 'isunlimited'}}), 'variables'
+        ({name: {'dimensions', 'datatype', 'FillValue', 'attributes'}}) and
+        'attributes' (global attributes).
+    '''
+    if isinstance(obj, dict):
+        return obj
+    if isinstance(obj, str):
+        if obj.endswith(('.json', '.yaml', '.yml')):
+            with open(obj) as fl:
+                if obj.endswith('.json'):
+                    return json.load(fl, object_pairs_hook=OrderedDict)
+                if yaml is None:
+                    raise ImportError('PyYAML is required to load headers from YAML')
+                return yaml.safe_load(fl)
+        fl = Dataset(obj)
+        try:
+            return header(fl)
+        finally:
+            fl.close()
+
+    head = OrderedDict()
+    dimensions = OrderedDict()
+    variables = OrderedDict()
+    if isinstance(obj, ncfile):
+        # format of the source, if the format of the saved file is not set
+        head['format'] = obj.format or obj.ifile.data_model
+        for name, dim in obj.dims.items():
+            dimensions[name] = OrderedDict([('size', dim['size']), ('isunlimited', dim['isunlimited'])])
+        for name, perem in obj.variab.items():
+            variables[name] = OrderedDict([('dimensions', list(perem['dimensions'])),
+                                           ('datatype', _typename(perem['datatype'])),
+                                           ('FillValue', perem['FillValue']),
+                                           ('attributes', OrderedDict(perem['attributes']))])
+        attributes = OrderedDict(obj.gattrs)
+    else:
+        head['format'] = obj.data_model
+        for name, dim in obj.dimensions.items():
+            dimensions[name] = OrderedDict([('size', len(dim)), ('isunlimited', dim.isunlimited())])
+        for name, var in obj.variables.items():
+            attrs = OrderedDict((attr, var.getncattr(attr)) for attr in var.ncattrs())
+            variables[name] = OrderedDict([('dimensions', list(var.dimensions)),
+                                           ('datatype', _typename(var.dtype)),
+                                           ('FillValue', attrs.pop('_FillValue', None)),
+                                           ('attributes', attrs)])
+        attributes = OrderedDict((attr, obj.getncattr(attr)) for attr in obj.ncattrs())
+    head['dimensions'] = dimensions
+    head['variables'] = variables
+    head['attributes'] = attributes
+    return head
+
+def _plainvalue(obj):
+    '''Replace numpy values in the header by numbers and lists.'''
+    if isinstance(obj, dict):
+        return OrderedDict((key, _plainvalue(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_plainvalue(value) for value in obj]
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    return obj
+
+def dump_header(obj, fname):
+    '''Save the header to JSON or YAML file, e.g. to use it as a template.
+
+    Parameters
+    ----------
+    obj : ncfile, Dataset, str or dict
+        See `header`.
+    fname : str
+        Name of the file, YAML (requires PyYAML) if it ends with .yaml or .yml,
+        JSON otherwise.
+    '''
+    data = _plainvalue(header(obj))
+    with open(fname, 'w') as fl:
+        if fname.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is required to save headers as YAML')
+            yaml.safe_dump(_plain(data), fl, default_flow_style=None, sort_keys=False)
+        else:
+            json.dump(data, fl, indent=1)
+
+def _samevalue(first, second):
+    '''True if values of the header are the same. Numbers are compared in
+    the lower precision of the two (templates have float64 values of float32
+    attributes), NaNs are equal.'''
+    if isinstance(first, str) or isinstance(second, str):
+        return first == second
+    try:
+        first, second = np.ravel(first), np.ravel(second)
+    except Exception:
+        return first == second
+    if first.shape != second.shape:
+        return False
+    if first.dtype.kind in 'iuf' and second.dtype.kind in 'iuf':
+        floats = [dtype for dtype in (first.dtype, second.dtype) if dtype.kind == 'f']
+        if floats:
+            dtype = min(floats, key=lambda dtype: dtype.itemsize)
+            return np.array_equal(first.astype(dtype), second.astype(dtype), equal_nan=True)
+    return np.array_equal(first, second)
+
+def _diffdict(first, second, path, partial, differences):
+    for key in list(first) + [key for key in second if key not in first]:
+        if key not in second:
+            differences.append((path + (key,), first[key], None))
+        elif key not in first:
+            if not partial:
+                differences.append((path + (key,), None, second[key]))
+        elif isinstance(first[key], dict) and isinstance(second[key], dict):
+            _diffdict(first[key], second[key], path + (key,), partial, differences)
+        elif not _samevalue(first[key], second[key]):
+            differences.append((path + (key,), first[key], second[key]))
+
+def diff(first, second, partial=False):
+    '''Differences between the headers of two files.
+
+    Dimensions, variables (their dimensions, data types, fill values and
+    attributes) and global attributes are compared. The data of the
+    variables are not read.
+
+    Parameters
+    ----------
+    first, second : ncfile, Dataset, str or dict
+        Files or templates, see `header`.
+    partial : bool
+        If True, `first` is a template, that describes only a part of the
+        header: dimensions, variables, attributes and keys, that are not
+        in `first`, are not compared.
+
+    Returns
+    -------
+    list
+        (path, value in `first`, value in `second`) for every difference,
+        path is the tuple of keys in the header, like ('variables', 'temp',
+        'attributes', 'units'). The value is None, if there is no such key.
+        Empty list if the headers are the same.
+    '''
+    differences = []
+    _diffdict(header(first), header(second), (), partial, differences)
+    return differences
+
+def _validate_file(fname, template, partial):
+    '''Compare header of the file with the template, catch errors.'''
+    try:
+        return diff(template, fname, partial), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def validate(files, template, partial=True, workers=None, progress=None):
+    '''Compare headers of many files with the template.
+
+    Only the headers of the files are read. Files are sent to the processes
+    in groups, so thousands of files can be checked quickly.
+
+    Parameters
+    ----------
+    files : list or str
+        List of file names or glob pattern, like 'data/*.nc'.
+    template : ncfile, Dataset, str or dict
+        Expected header, see `header`. Templates can be saved with `dump_header`.
+    partial : bool
+        Compare only what is in the template, see `diff`.
+    workers : int, optional
+        Number of processes, by default number of CPUs. If 1, files are
+        checked in the current process.
+    progress : callable, optional
+        Called after every file with (number of checked files, number of files,
+        file name, error message or None).
+
+    Returns
+    -------
+    list
+        (file name, differences (see `diff`), error message or None) for
+        every file, in the order of `files`.
+    '''
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    template = header(template)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    results = []
+    if workers == 1 or len(files) <= 1:
+        checked = (_validate_file(fname, template, partial) for fname in files)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        chunksize = max(1, len(files) // (4 * workers))
+        checked = pool.map(_validate_file, files, itertools.repeat(template),
+                           itertools.repeat(partial), chunksize=chunksize)
+    try:
+        for i, (fname, (differences, error)) in enumerate(zip(files, checked)):
+            results.append((fname, differences, error))
+            if progress is not None:
+                progress(i + 1, len(files), fname, error)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return results
+
+def main(argv=None):
+    '''Command line interface: apply recipe from JSON file to many netCDF files.'''
+    parser = argparse.ArgumentParser(prog='fixnc',
+                                     description='Apply the same edits to many netCDF files.')
+    parser.add_argument('recipe', help='JSON or YAML file with list of [method, [arguments]] edits')
+    parser.add_argument('files', nargs='+', help='netCDF files or glob patterns')
+    parser.add_argument('-o', '--outdir', help='directory for the saved files')
+    parser.add_argument('-s', '--suffix', help='suffix for the names of the saved files')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--headeronly', action='store_true',
+                        help='edit headers of the copies of the files, without rewriting the data')
+    parser.add_argument('--format', help='format of the saved files')
+    parser.add_argument('--compression', help='compression preset: ' + ', '.join(COMPRESSION))
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not report progress')
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+    files = []
+    for pattern in args.files:
+        files.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    kwargs = {}
+    if args.format:
+        kwargs['format'] = args.format
+    if args.compression:
+        kwargs['compression'] = args.compression
+
+    def progress(done, total, fname, error):
+        if error is not None:
+            sys.stderr.write('[{}/{}] {} FAILED\n{}'.format(done, total, fname, error))
+        elif not args.quiet:
+            sys.stderr.write('[{}/{}] {}\n'.format(done, total, fname))
+
+    results = batch(files, recipe, args.outdir, args.suffix, args.workers,
+                    args.headeronly, progress, **kwargs)
+    nfailed = sum(1 for result in results if result[2] is not None)
+    if nfailed:
+        sys.stderr.write('{} of {} files failed\n'.format(nfailed, len(results)))
+        return 1
+    return 0
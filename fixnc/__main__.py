@@ -0,0 +1,5 @@
+import sys
+
+from fixnc import main
+
+sys.exit(main())
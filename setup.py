@@ -15,13 +15,14 @@ CLASSIFIERS = [
     'Operating System :: OS Independent',
     'Intended Audience :: Science/Research',
     'Programming Language :: Python',
-    'Programming Language :: Python :: 2',
-    'Programming Language :: Python :: 2.7',
+    'Programming Language :: Python :: 3',
+    'Programming Language :: Python :: 3.8',
     'Topic :: Scientific/Engineering',
 ]
 
-INSTALL_REQUIRES = ['netcdf4 >= 1.1.8', 'sh >= 1.11']
+INSTALL_REQUIRES = ['netcdf4 >= 1.6.0']
 TESTS_REQUIRE = ['pytest >= 2.7.1']
+EXTRAS_REQUIRE = {'h5py': ['h5py >= 3.0']}
 
 DESCRIPTION = "Easy edit of netCDF files."
 LONG_DESCRIPTION = """
@@ -54,9 +55,12 @@ setup(name=DISTNAME,
       description=DESCRIPTION,
       long_description=LONG_DESCRIPTION,
       install_requires=INSTALL_REQUIRES,
+      extras_require=EXTRAS_REQUIRE,
       tests_require=TESTS_REQUIRE,
       url=URL,
+      python_requires='>=3.8',
       packages=['fixnc'],
+      entry_points={'console_scripts': ['fixnc = fixnc:main']},
       include_package_data=True,
       zip_safe=False)
       
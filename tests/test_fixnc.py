@@ -3,6 +3,8 @@ import fixnc as fnc
 from netCDF4 import Dataset
 from collections import OrderedDict
 import os
+import shutil
+import json
 import numpy as np
 
 fl2 = Dataset('./tests/test.nc')
@@ -82,3 +84,810 @@ def test_save():
 
 
 
+def test_save_headeronly(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_dim('X', 'lon')
+    ncs.rename_var('mytemp', 'temp')
+    ncs.rename_attr('T', 'unuts', 'units')
+    ncs.add_gattr('history', 'fixed with fixnc')
+    assert ncs.headeronly
+    fname = str(tmpdir.join('header.nc'))
+    ncs.save(fname, headeronly=True)
+    fl = Dataset(fname)
+    assert list(fl.variables.keys()) == ['T', 'temp']
+    assert fl.variables['temp'].dimensions == ('T', 'lon', 'Y')
+    assert fl.variables['T'].units == 'hours since 2001-01-01 00:00:00'
+    assert fl.history == 'fixed with fixnc'
+    assert np.array_equal(fl.variables['temp'][:], ncs.ifile.variables['mytemp'][:])
+
+def test_save_headeronly_coordinate(tmpdir):
+    fname = str(tmpdir.join('header.nc'))
+    for dim, var in ((True, False), (False, True)):
+        ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+        if dim:
+            ncs.rename_dim('T', 'time')
+        if var:
+            ncs.rename_var('T', 'time')
+        assert ncs.headeronly
+        ncs.save(fname, headeronly=True)
+        fl = Dataset(fname)
+        name = 'time' if var else 'T'
+        assert np.array_equal(fl.variables[name][:], ncs.ifile.variables['T'][:])
+        fl.close()
+    # netCDF-4 loses the data of the coordinate variable renamed with its dimension
+    ncs.rename_dim('T', 'time')
+    assert not ncs.headeronly
+    ncs.save(fname)
+    fl = Dataset(fname)
+    assert np.array_equal(fl.variables['time'][:], ncs.ifile.variables['T'][:])
+    fl.close()
+
+def test_save_headeronly_inplace(tmpdir):
+    fname = str(tmpdir.join('inplace.nc'))
+    fnc.ncfile(Dataset('./tests/test.nc')).save(fname)
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.change_attr('mytemp', 'longname', 'Sea temperature')
+    ncs.save(fname, headeronly=True)
+    assert ncs.ifile.variables['mytemp'].longname == 'Sea temperature'
+    assert ncs.edits == []
+
+def test_save_headeronly_failed(tmpdir):
+    fname = str(tmpdir.join('inplace.nc'))
+    shutil.copyfile('./tests/test.nc', fname)
+    out = str(tmpdir.join('out.nc'))
+    for target in (out, fname):
+        ncs = fnc.ncfile(Dataset(fname))
+        ncs.add_attr('mytemp', '_FillValue', 3.0)
+        with pytest.raises(Exception):
+            ncs.save(target, headeronly=True)
+        assert os.listdir(str(tmpdir)) == ['inplace.nc']
+        # the ncfile can be used further and the files are not locked
+        assert ncs.ifile.isopen()
+        assert ncs.variab['mytemp']['data'][:].shape == (5, 10, 10)
+        fnc.ncfile(Dataset('./tests/test.nc')).save(out)
+        os.remove(out)
+
+def test_save_headeronly_structural():
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    assert not ncs.headeronly
+    with pytest.raises(ValueError):
+        ncs.save('./tests/never.nc', headeronly=True)
+
+def test_status():
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    assert ncs.status('mytemp') == 'untouched'
+    ncs.rename_var('mytemp', 'temp')
+    ncs.add_attr('temp', 'units', 'K')
+    assert ncs.status('temp') == 'metadata'
+    assert ncs.journal['temp']['source'] == 'mytemp'
+    assert ncs.journal['temp']['changes'] == ['renamed', 'reattributed']
+    ncs.change_dtype('temp', np.dtype('float64'))
+    assert ncs.status('temp') == 'retyped'
+    ncs.change_data('T', np.arange(5))
+    assert ncs.status('T') == 'redataed'
+    ncs.add_var('zeros', fnc.create_variable(np.zeros(10), ('X',)))
+    assert ncs.status('zeros') == 'added'
+    ncs.del_var('zeros')
+    assert 'zeros' not in ncs.journal
+
+def test_save_passthrough(tmpdir):
+    fname = str(tmpdir.join('compressed.nc'))
+    fl = Dataset(fname, 'w')
+    fl.createDimension('time', None)
+    fl.createDimension('x', 7)
+    var = fl.createVariable('var', 'f4', ('time', 'x'), zlib=True, complevel=6,
+                            shuffle=True, chunksizes=(2, 7), fill_value=-9.)
+    var[:] = np.random.rand(5, 7)
+    fl.close()
+
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.rename_dim('time', 'T')
+    ncs.rename_var('var', 'newvar')
+    assert ncs._passthrough_source(ncs._h5source(), 'newvar', ncs.variab['newvar']) == ('var' if fnc.h5py else None)
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out)
+    fl = Dataset(out)
+    assert len(fl.dimensions['T']) == 5
+    assert fl.variables['newvar'].chunking() == [2, 7]
+    assert fl.variables['newvar'].filters()['complevel'] == 6
+    assert np.array_equal(fl.variables['newvar'][:], ncs.ifile.variables['var'][:])
+
+@pytest.mark.skipif(fnc.h5py is None, reason='requires h5py')
+def test_save_workers(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_dim('T', 'time')
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    ncs.add_var('zeros', fnc.create_variable(np.zeros((5, 10)), ('time', 'X'), True))
+    serial = str(tmpdir.join('serial.nc'))
+    parallel = str(tmpdir.join('parallel.nc'))
+    ncs.save(serial, passthrough=False)
+    ncs.save(parallel, passthrough=False, workers=2)
+    fl1 = Dataset(serial)
+    fl2 = Dataset(parallel)
+    assert list(fl2.variables.keys()) == list(fl1.variables.keys())
+    for name in fl1.variables:
+        assert fl2.variables[name].dtype == fl1.variables[name].dtype
+        assert fl2.variables[name].chunking() == fl1.variables[name].chunking()
+        assert np.array_equal(fl2.variables[name][:], fl1.variables[name][:])
+    assert len(os.listdir(str(tmpdir))) == 2
+
+@pytest.mark.parametrize('format', ['NETCDF4', 'NETCDF3_CLASSIC'])
+def test_save_raw_encoding(tmpdir, format):
+    fname = str(tmpdir.join('test.nc'))
+    fl = Dataset(fname, 'w', format=format)
+    fl.createDimension('x', 4)
+    kwargs = {'zlib': True} if format == 'NETCDF4' else {}
+    packed = fl.createVariable('p', 'i2', ('x',), **kwargs)
+    packed.scale_factor = 0.1
+    packed.set_auto_maskandscale(False)
+    packed[:] = [1, 2, 3, 4]
+    fl.createVariable('n', 'f4', ('x',), fill_value=np.nan, **kwargs)[:] = [1, 2, np.nan, 4]
+    fl.close()
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.format = format
+    ncs.change_attr('p', 'scale_factor', 0.01)
+    # values are packed again with the new scale factor
+    assert not ncs._rawcopy('p', ncs.variab['p'])
+    # NaN fill values are the same
+    assert ncs._rawcopy('n', ncs.variab['n'])
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out)
+    fl = Dataset(out)
+    assert np.allclose(fl.variables['p'][:], [0.1, 0.2, 0.3, 0.4])
+    assert np.allclose(fl.variables['n'][:].filled(0), [1, 2, 0, 4])
+    if format == 'NETCDF4' and fnc.h5py is not None:
+        assert ncs.stats.variables['n']['method'] == 'passthrough'
+        assert ncs.stats.variables['p']['method'] == 'copy'
+
+def test_save_prefetch(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    ncs.add_var('zeros', fnc.create_variable(np.zeros((5, 10)), ('T', 'X'), True))
+    ncs.isel(X=slice(1, 8))
+    ncs.max_memory = 200
+    ncs.prefetch = 2
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname, passthrough=False)
+    fl = Dataset(fname)
+    src = Dataset('./tests/test.nc')
+    assert np.array_equal(fl.variables['mytemp'][:], src.variables['mytemp'][:, 1:8])
+    assert np.array_equal(fl.variables['T'][:], src.variables['T'][:])
+    assert np.array_equal(fl.variables['zeros'][:], np.zeros((5, 7)))
+
+def test_prefetch_reader_died():
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    reader = fnc._prefetcher(ncs._portable(), 2, 1000)
+    reader.terminate()
+    reader.read('mytemp', [(slice(0, 1), slice(0, 10), slice(0, 10))])
+    with pytest.raises(RuntimeError):
+        reader.get()
+
+def test_save_stats(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    ncs.add_var('zeros', fnc.create_variable(np.zeros((5, 10)), ('T', 'X'), True))
+    ncs.max_memory = 200
+    events = []
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname, passthrough=False, stats=fnc.savestats(events.append))
+    stats = ncs.stats
+    assert list(stats.variables) == list(ncs.variab)
+    assert stats.variables['mytemp']['method'] == 'copy'
+    assert stats.variables['zeros']['method'] == 'array'
+    assert stats.variables['mytemp']['read'] == 5 * 10 * 10 * 4
+    assert stats.variables['mytemp']['written'] == 5 * 10 * 10 * 8
+    assert len(stats.variables['mytemp']['slabs']) > 1
+    assert {'create', 'read', 'convert', 'write', 'close'} <= set(stats.phases)
+    assert events[-1]['event'] == 'done'
+    assert [event['variable'] for event in events if event['event'] == 'variable'] == list(ncs.variab)
+    assert 'mytemp' in stats.summary()
+    loaded = json.loads(stats.to_json(str(tmpdir.join('stats.json')), slabs=False))
+    assert loaded['variables']['mytemp']['written'] == 5 * 10 * 10 * 8
+    assert 'slabs' not in loaded['variables']['mytemp']
+
+@pytest.mark.parametrize('sync', [{}, {'sync_variables': 1}, {'sync_bytes': '100B'}])
+def test_save_sync(tmpdir, sync):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.add_gattr('history', 'fixed with fixnc')
+    for name, value in sync.items():
+        setattr(ncs, name, value)
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname, passthrough=False)
+    synced = [vari for vari, stats in ncs.stats.variables.items() if 'sync' in stats['phases']]
+    if sync:
+        # T is 20 bytes, mytemp 2000 bytes
+        assert synced == (['T', 'mytemp'] if 'sync_variables' in sync else ['mytemp'])
+    else:
+        assert synced == []
+    fl = Dataset(fname)
+    assert fl.history == 'fixed with fixnc'
+    assert np.array_equal(fl.variables['mytemp'][:], Dataset('./tests/test.nc').variables['mytemp'][:])
+
+def test_save_atomic(tmpdir):
+    fname = str(tmpdir.join('out.nc'))
+    with open(fname, 'w') as outfile:
+        outfile.write('previous')
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    def fail(key):
+        raise RuntimeError('interrupted')
+    ncs.add_var('index', fnc.create_variable(fail, ('X', 'Y'), datatype='int32'))
+    with pytest.raises(RuntimeError):
+        ncs.save(fname)
+    # the previous file is intact and nothing is left behind
+    assert open(fname).read() == 'previous'
+    assert os.listdir(str(tmpdir)) == ['out.nc']
+
+def test_save_inplace(tmpdir):
+    fname = str(tmpdir.join('test.nc'))
+    shutil.copyfile('./tests/test.nc', fname)
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    ncs.save(fname)
+    fl = Dataset(fname)
+    assert fl.variables['mytemp'].dtype == np.dtype('float64')
+    assert np.array_equal(fl.variables['mytemp'][:], Dataset('./tests/test.nc').variables['mytemp'][:])
+
+@pytest.mark.parametrize('format', ['NETCDF4', 'NETCDF3_CLASSIC'])
+def test_save_inplace_twice(tmpdir, format):
+    fname = str(tmpdir.join('test.nc'))
+    fl = Dataset(fname, 'w', format=format)
+    fl.createDimension('x', 4)
+    kwargs = {'zlib': True} if format == 'NETCDF4' else {}
+    fl.createVariable('a', 'f4', ('x',), **kwargs)[:] = [1, 2, 3, 4]
+    fl.createVariable('b', 'f4', ('x',), **kwargs)[:] = [5, 6, 7, 8]
+    fl.close()
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.format = format
+    ncs.rename_var('a', 'c')
+    ncs.rename_var('b', 'a')
+    ncs.rename_var('c', 'b')
+    ncs.reorder_vars(['b', 'a'])
+    ncs.save(fname)
+    assert ncs.format == format and ncs.edits == []
+    # the ncfile is the saved file now, the second save changes nothing
+    ncs.save(fname)
+    fl = Dataset(fname)
+    assert list(fl.variables) == ['b', 'a']
+    assert np.array_equal(fl.variables['a'][:], [5, 6, 7, 8])
+    assert np.array_equal(fl.variables['b'][:], [1, 2, 3, 4])
+
+@pytest.mark.parametrize('format', ['NETCDF4', 'NETCDF3_CLASSIC'])
+def test_save_resume(tmpdir, format):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    keys = []
+    def index(key):
+        if len(keys) == 3 and not resumed:
+            raise RuntimeError('interrupted')
+        keys.append(key)
+        return np.arange(100).reshape(10, 10)[key]
+    ncs.add_var('index', fnc.create_variable(index, ('X', 'Y'), datatype='int32'))
+    # not created before the interruption
+    ncs.add_var('last', fnc.create_variable(lambda key: np.ones((10, 10))[key], ('X', 'Y')))
+    ncs.format = format
+    ncs.max_memory = 100
+    ncs.sync_bytes = 1
+    fname = str(tmpdir.join('out.nc'))
+    resumed = False
+    with pytest.raises(RuntimeError):
+        ncs.save(fname, passthrough=False, resume=True)
+    assert os.path.exists(fname + '.part') and not os.path.exists(fname)
+    with Dataset(fname + '.part') as part:
+        assert 'last' not in part.variables
+    resumed = True
+    ncs.save(fname, passthrough=False, resume=True)
+    assert sorted(os.listdir(str(tmpdir))) == ['out.nc']
+    assert ncs.stats.variables['T']['method'] == 'resumed'
+    assert ncs.stats.variables['mytemp']['method'] == 'resumed'
+    # slabs, written before the interruption, are not computed again
+    assert len(keys) == len(set(str(key) for key in keys))
+    fl = Dataset(fname)
+    assert np.array_equal(fl.variables['index'][:], np.arange(100).reshape(10, 10))
+    assert np.array_equal(fl.variables['last'][:], np.ones((10, 10)))
+    assert np.array_equal(fl.variables['mytemp'][:], Dataset('./tests/test.nc').variables['mytemp'][:])
+
+@pytest.mark.parametrize('format', ['NETCDF4', 'NETCDF3_CLASSIC'])
+def test_save_memory(tmpdir, format):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_var('mytemp', 'temp')
+    ncs.add_gattr('history', 'fixed with fixnc')
+    ncs.format = format
+    data = ncs.save(None)
+    fl = Dataset('out.nc', memory=data)
+    assert fl.history == 'fixed with fixnc'
+    assert fl.data_model == format
+    assert np.array_equal(fl.variables['temp'][:], Dataset('./tests/test.nc').variables['mytemp'][:])
+    fname = str(tmpdir.join('out.nc'))
+    with open(fname, 'wb') as outfile:
+        assert ncs.save(outfile) is None
+    assert open(fname, 'rb').read() == data
+    with pytest.raises(ValueError):
+        ncs.save(None, headeronly=True)
+
+def test_diff(tmpdir, capsys):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    assert ncs.diff(Dataset('./tests/test.nc')) == []
+    ncs.format = 'NETCDF4_CLASSIC'
+    assert ncs.diff(Dataset('./tests/test.nc')) == [(('format',), 'NETCDF4_CLASSIC', 'NETCDF4')]
+    ncs.format = 'NETCDF4'
+    assert ncs.diff(Dataset('./tests/test.nc')) == []
+    repr(ncs)
+    assert capsys.readouterr().out == ''
+    ncs.rename_attr('T', 'unuts', 'units')
+    ncs.add_gattr('history', 'fixed with fixnc')
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    differences = ncs.diff('./tests/test.nc')
+    assert (('variables', 'T', 'attributes', 'units'), 'hours since 2001-01-01 00:00:00', None) in differences
+    assert (('variables', 'T', 'attributes', 'unuts'), None, 'hours since 2001-01-01 00:00:00') in differences
+    assert (('variables', 'mytemp', 'datatype'), 'float64', 'float32') in differences
+    assert (('attributes', 'history'), 'fixed with fixnc', None) in differences
+    assert len(differences) == 4
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname)
+    assert ncs.diff(fname) == []
+
+def test_validate(tmpdir):
+    fname = str(tmpdir.join('template.json'))
+    fnc.dump_header('./tests/test.nc', fname)
+    # template with a part of the header, float values as in JSON
+    template = {'dimensions': {'T': {'isunlimited': True}},
+                'variables': {'mytemp': {'datatype': 'float32', 'attributes': {'scale': 0.1}}}}
+    shutil.copyfile('./tests/test.nc', str(tmpdir.join('a.nc')))
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.add_attr('mytemp', 'scale', np.float32(0.1))
+    ncs.format = 'NETCDF4'
+    ncs.save(str(tmpdir.join('b.nc')))
+    files = [str(tmpdir.join('a.nc')), str(tmpdir.join('b.nc')), str(tmpdir.join('missing.nc'))]
+    results = fnc.validate(files, fname, partial=False, workers=1)
+    assert results[0] == (files[0], [], None)
+    assert results[1][1] == [(('variables', 'mytemp', 'attributes', 'scale'), None, np.float32(0.1))]
+    assert results[2][1] is None and results[2][2] is not None
+    results = fnc.validate(files[:2], template, workers=1)
+    assert results[0][1] == [(('variables', 'mytemp', 'attributes', 'scale'), 0.1, None)]
+    assert results[1][1] == []
+
+def test_save_computed(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_var('mytemp', 'temp')
+    ncs.add_var('speed', fnc.create_variable(fnc.derived(np.hypot, 'temp', 'temp'),
+                                             ('T', 'X', 'Y'), True))
+    keys = []
+    def index(key):
+        keys.append(key)
+        return np.arange(100).reshape(10, 10)[key]
+    ncs.add_var('index', fnc.create_variable(index, ('X', 'Y'), datatype='int32'))
+    ncs.isel(Y=slice(2, 6))
+    ncs.max_memory = 100
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname)
+    fl = Dataset(fname)
+    src = Dataset('./tests/test.nc').variables['mytemp'][:, :, 2:6]
+    assert np.allclose(fl.variables['speed'][:], np.hypot(src, src))
+    assert np.array_equal(fl.variables['index'][:], np.arange(100).reshape(10, 10)[:, 2:6])
+    assert len(keys) > 1
+
+def test_change_dtype_pack(tmpdir):
+    fname = str(tmpdir.join('double.nc'))
+    fl = Dataset(fname, 'w')
+    fl.createDimension('time', None)
+    fl.createDimension('x', 50)
+    var = fl.createVariable('temp', 'f8', ('time', 'x'), fill_value=1e20)
+    var.valid_range = np.array([200., 400.])
+    var.missing_value = 1e20
+    values = np.ma.masked_array(np.random.uniform(250, 310, (4, 50)))
+    values[1, 3] = np.ma.masked
+    var[:] = values
+    fl.createVariable('big', 'f8', ('x',))[:] = np.linspace(0, 1000, 50)
+    fl.close()
+
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.change_dtype('temp', 'int16', pack=True)
+    ncs.change_dtype('big', 'float32')
+    ncs.max_memory = 800
+    out = str(tmpdir.join('packed.nc'))
+    ncs.save(out)
+    fl = Dataset(out)
+    assert fl.variables['temp'].dtype == np.int16
+    saved = fl.variables['temp'][:]
+    precision = ncs.journal['temp']['precision']
+    assert precision['bounds'] == (values.min(), values.max())
+    assert precision['max_error'] <= precision['scale_factor'] / 2 * 1.001
+    assert np.ma.allclose(saved, values, atol=precision['scale_factor'])
+    assert saved.mask[1, 3]
+    assert saved.count() == values.count()
+    # valid range and missing value are packed too
+    assert fl.variables['temp'].valid_range.dtype == np.int16
+    assert fl.variables['temp'].missing_value == fl.variables['temp']._FillValue
+    assert 0 < ncs.journal['big']['precision']['max_error'] < 1e-4
+
+    ncs.change_dtype('temp', 'int16', pack=True, bounds=(260, 300))
+    with pytest.raises(ValueError):
+        ncs.save(out)
+    ncs.change_dtype('temp', 'float32')
+    ncs.change_dtype('big', 'int8')
+    with pytest.raises(ValueError):
+        ncs.save(out)
+    with pytest.raises(ValueError):
+        ncs.change_dtype('big', 'float32', pack=True)
+    # FillValue is checked too
+    ncs.change_dtype('big', 'float32')
+    ncs.change_dtype('temp', 'int16')
+    with pytest.raises(ValueError):
+        ncs.save(out)
+
+def test_change_dtype_new_data(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    out = str(tmpdir.join('out.nc'))
+    ncs.add_var('big', fnc.create_variable(np.array([1., 2., 3., 4., 998.]), ('T',), True))
+    ncs.change_dtype('big', 'int8')
+    with pytest.raises(ValueError):
+        ncs.save(out)
+    values = np.linspace(250, 310, 100).reshape(10, 10)
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.change_data('mytemp', np.ma.masked_array([values] * 5))
+    ncs.change_dtype('mytemp', 'int16', pack=True)
+    ncs.save(out)
+    precision = ncs.journal['mytemp']['precision']
+    assert precision['bounds'] == (250, 310)
+    assert np.ma.allclose(Dataset(out).variables['mytemp'][:], [values] * 5, atol=precision['scale_factor'])
+
+def test_dump_variable(tmpdir):
+    import pickle
+    data = np.ma.masked_array(np.arange(50.).reshape(5, 10), mask=np.arange(50).reshape(5, 10) % 7 == 0)
+    var = fnc.create_variable(data, ('T', 'X'), True, 'float64', -1.,
+                              OrderedDict([('units', 'K'), ('valid_range', np.array([0., 100.]))]))
+    src = Dataset('./tests/test.nc')
+    fromfile = fnc.create_variable(src.variables['mytemp'], ('T', 'X', 'Y'), True)
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    for name, variable in (('var.json', var), ('var.nc', var), ('temp.json', fromfile), ('temp.nc', fromfile)):
+        fname = str(tmpdir.join(name))
+        fnc.dump_variable(variable, fname, max_memory=100)
+        loaded = fnc.load_variable(fname)
+        assert loaded['dimensions'] == variable['dimensions']
+        assert loaded['datatype'] == variable['datatype']
+        assert not fnc._inmemory(loaded['data'])
+        assert np.ma.allequal(loaded['data'][:], variable['data'][:])
+        ncs.add_var(name.replace('.', '_'), loaded)
+    assert np.array_equal(fnc.load_variable(str(tmpdir.join('var.json')))['data'].mask, data.mask)
+    assert fnc.load_variable(str(tmpdir.join('var.nc')))['attributes']['units'] == 'K'
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out)
+    assert np.ma.allequal(Dataset(out).variables['var_json'][:], data)
+
+    legacy = str(tmpdir.join('legacy.pkl'))
+    with open(legacy, 'wb') as outfile:
+        pickle.dump(var, outfile)
+    with pytest.raises(ValueError):
+        fnc.load_variable(legacy)
+    assert np.ma.allequal(fnc.load_variable(legacy, allow_pickle=True)['data'], data)
+
+def test_pickle():
+    import pickle
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_var('mytemp', 'temp')
+    ncs2 = pickle.loads(pickle.dumps(ncs))
+    assert list(ncs2.variab.keys()) == ['T', 'temp']
+    assert np.array_equal(ncs2.variab['temp']['data'][:], ncs.variab['temp']['data'][:])
+    assert ncs2.edits == ncs.edits
+
+def test_lazy_header():
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    var = ncs.variab['mytemp']
+    assert var._ncvar is not None
+    ncs.rename_dim('X', 'lon')
+    assert var._ncvar is not None
+    assert var['attributes'] == {'longname': 'Temperature', 'shortname': 'temp'}
+    assert var._ncvar is None
+    assert list(var.keys()) == ['data', 'dimensions', 'unlimdimname', 'hasunlimdim',
+                                'datatype', 'FillValue', 'attributes', 'chunking',
+                                'filters', 'endian']
+    assert var['dimensions'] == ('T', 'lon', 'Y')
+    assert dict(ncs.variab['T'])['attributes'] == {'unuts': 'hours since 2001-01-01 00:00:00'}
+
+def test_parse_size():
+    assert fnc.parse_size(100) == 100
+    assert fnc.parse_size('512MB') == 512 * 1024**2
+    assert fnc.parse_size('2G') == 2 * 1024**3
+    assert fnc.parse_size('1.5kB') == 1536
+    with pytest.raises(ValueError):
+        fnc.parse_size('lots')
+
+def test_slabs():
+    slabs = list(fnc._slabs((10, 10, 10), 4, 2000))
+    assert slabs == [(slice(0, 5), slice(None), slice(None)), (slice(5, 10), slice(None), slice(None))]
+    slabs = list(fnc._slabs((2, 10, 10), 4, 100))
+    assert len(slabs) == 10
+    assert slabs[0] == (slice(0, 1), slice(0, 2), slice(None))
+    assert list(fnc._slabs((), 4, 1)) == [()]
+
+def test_save_max_memory(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.max_memory = 100
+    ncs.add_var('ones', fnc.create_variable(np.ones((10, 10)), ('X', 'Y')))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    fname = str(tmpdir.join('out.nc'))
+    ncs.save(fname, passthrough=False)
+    fl = Dataset(fname)
+    assert np.array_equal(fl.variables['mytemp'][:], ncs.ifile.variables['mytemp'][:])
+    assert np.array_equal(fl.variables['ones'][:], np.ones((10, 10)))
+
+def test_nrecords():
+    assert fnc._nrecords(100, 1000) == 10
+    assert fnc._nrecords(100, 1000, (4,)) == 8
+    assert fnc._nrecords(100, 1000, (4, 3)) == 8
+    assert fnc._nrecords(100, 1500, (4, 3)) == 12
+    assert fnc._nrecords(100, 300, (8,)) == 2
+    assert fnc._nrecords(1000, 100, (8,)) == 1
+    # slabs do not cross the chunks
+    assert fnc._nrecords(100, 400, (10,)) == 2
+    assert fnc._nrecords(100, 600, (12,)) == 6
+
+def test_save_nchunk(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.change_dtype('mytemp', np.dtype('float64'))
+    ncs.istart = 1
+    ncs.istop = 4
+    for nchunk in ('auto', 2, None):
+        ncs.nchunk = nchunk
+        fname = str(tmpdir.join('out{}.nc'.format(nchunk)))
+        ncs.save(fname)
+        fl = Dataset(fname)
+        assert len(fl.dimensions['T']) == 3
+        assert np.array_equal(fl.variables['mytemp'][:], ncs.ifile.variables['mytemp'][1:4])
+
+def test_concat(tmpdir):
+    names = []
+    for istart, istop in ((0, 3), (3, 5)):
+        part = fnc.ncfile(Dataset('./tests/test.nc'))
+        part.istart, part.istop = istart, istop
+        names.append(str(tmpdir.join('part{}.nc'.format(istart))))
+        part.save(names[-1])
+
+    ncs = fnc.ncfile([Dataset(name) for name in names])
+    assert ncs.dims['T']['size'] == 5
+    assert not ncs.headeronly
+    ncs.rename_dim('T', 'time')
+    src = Dataset('./tests/test.nc')
+    assert np.array_equal(ncs.variab['mytemp']['data'][1:4, 2], src.variables['mytemp'][1:4, 2])
+    assert np.array_equal(ncs.variab['T']['data'][4], src.variables['T'][4])
+    for nchunk in ('auto', 2):
+        ncs.nchunk = nchunk
+        fname = str(tmpdir.join('out.nc'))
+        ncs.save(fname)
+        fl = Dataset(fname)
+        assert len(fl.dimensions['time']) == 5
+        for name in ('T', 'mytemp'):
+            assert np.array_equal(fl.variables[name][:], src.variables[name][:])
+        fl.close()
+
+    other = fnc.ncfile(Dataset('./tests/test.nc'))
+    other.change_dtype('mytemp', np.dtype('float64'))
+    other.save(str(tmpdir.join('other.nc')))
+    with pytest.raises(ValueError):
+        fnc.ncfile([Dataset(names[0]), Dataset(str(tmpdir.join('other.nc')))])
+
+def test_isel(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.isel(T=slice(1, None, 2), X=slice(2, 8))
+    ncs.isel({'Y': 3}, X=slice(1, None))
+    ncs.rename_dim('X', 'lon')
+    assert [dim['size'] for dim in ncs.dims.values()] == [5, 1, 2]
+    assert list(ncs.selection.keys()) == ['T', 'lon', 'Y']
+    src = Dataset('./tests/test.nc')
+    for max_memory in ('512MB', 40):
+        ncs.max_memory = max_memory
+        fname = str(tmpdir.join('out.nc'))
+        ncs.save(fname)
+        fl = Dataset(fname)
+        assert fl.variables['mytemp'].shape == (2, 5, 1)
+        assert np.array_equal(fl.variables['mytemp'][:], src.variables['mytemp'][1::2, 3:8, 3:4])
+        assert np.array_equal(fl.variables['T'][:], src.variables['T'][1::2])
+        fl.close()
+    recipe = fnc.decode_recipe(fnc.encode_recipe(ncs.edits))
+    assert recipe[0] == ('isel', (OrderedDict([('T', slice(1, None, 2)), ('X', slice(2, 8))]),))
+    with pytest.raises(ValueError):
+        ncs.isel(lon=slice(None, None, -1))
+    with pytest.raises(ValueError):
+        ncs.isel(lat=0)
+
+@pytest.mark.parametrize('format', ['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA'])
+@pytest.mark.parametrize('nrecvars', [1, 2])
+def test_save_mapped(tmpdir, format, nrecvars):
+    fname = str(tmpdir.join('classic.nc'))
+    fl = Dataset(fname, 'w', format=format)
+    fl.title = 'classic'
+    fl.createDimension('time', None)
+    fl.createDimension('x', 3)
+    fl.createDimension('y', 4)
+    fl.createVariable('scalar', 'i4')[...] = 7
+    fl.createVariable('grid', 'f8', ('x', 'y'))[:] = np.random.rand(3, 4)
+    packed = fl.createVariable('packed', 'i2', ('time', 'x'), fill_value=-1)
+    packed.setncatts({'scale_factor': 0.5, 'add_offset': np.float32(1), 'units': 'K'})
+    packed[:] = np.ma.masked_array([[1, 2, 3], [4, 5, 6]], mask=[[0, 1, 0], [0, 0, 0]])
+    if nrecvars == 2:
+        fl.createVariable('rec', 'f4', ('time', 'y'))[:] = np.random.rand(2, 4)
+    fl.close()
+
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.format = format
+    ncs.rename_var('packed', 'temp')
+    ncs.max_memory = 8
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out)
+    src = Dataset(fname)
+    src.set_auto_maskandscale(False)
+    fl = Dataset(out)
+    fl.set_auto_maskandscale(False)
+    assert fl.title == 'classic'
+    for name in src.variables:
+        srcvar = src.variables[name]
+        newvar = fl.variables['temp' if name == 'packed' else name]
+        assert np.array_equal(newvar[:], srcvar[:])
+        mapped = ncs._mapped(ncs.variab[newvar.name]['data'])
+        assert isinstance(mapped, np.ndarray)
+        assert np.array_equal(mapped, srcvar[:])
+
+def test_save_raw(tmpdir):
+    fname = str(tmpdir.join('packed.nc'))
+    fl = Dataset(fname, 'w')
+    fl.createDimension('time', None)
+    fl.createDimension('x', 3)
+    packed = fl.createVariable('packed', 'i2', ('time', 'x'), fill_value=-1)
+    packed.setncatts({'scale_factor': 0.1, 'add_offset': 0.05, 'valid_max': np.int16(50)})
+    packed.set_auto_maskandscale(False)
+    packed[:] = [[1, 2, 3], [-1, 60, 7]]
+    fl.createVariable('other', 'f4', ('time', 'x'), fill_value=-9.)
+    fl.close()
+
+    ncs = fnc.ncfile(Dataset(fname))
+    ncs.rename_var('packed', 'temp')
+    ncs.change_data('other', np.ma.masked_array(np.ones((2, 3)), mask=[[0, 1, 0], [0, 0, 0]]))
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out, passthrough=False)
+    fl = Dataset(out)
+    assert fl.variables['other'][:].mask.tolist() == [[False, True, False], [False] * 3]
+    fl.set_auto_maskandscale(False)
+    assert fl.variables['temp'][:].tolist() == [[1, 2, 3], [-1, 60, 7]]
+    # source is read as before
+    assert ncs.variab['temp']['data'][:].mask.sum() == 2
+
+def test_save_storage(tmpdir):
+    fname = str(tmpdir.join('compressed.nc'))
+    fl = Dataset(fname, 'w')
+    fl.createDimension('time', None)
+    fl.createDimension('x', 7)
+    var = fl.createVariable('var', '>f8', ('time', 'x'), zlib=True, complevel=6,
+                            shuffle=True, chunksizes=(3, 7), endian='big')
+    var[:] = np.random.rand(5, 7)
+    fl.close()
+
+    ncs = fnc.ncfile(Dataset(fname))
+    assert ncs.variab['var']['chunking'] == [3, 7]
+    assert ncs.variab['var']['filters']['complevel'] == 6
+    assert ncs.variab['var']['endian'] == 'big'
+    ncs.change_dtype('var', np.dtype('float32'))
+    ncs.add_var('copy', fnc.create_variable(ncs.ifile.variables['var'], ('time', 'x'), True,
+                                            filters={'zlib': True, 'complevel': 2}))
+    ncs.change_chunking('copy', [1, 7])
+    out = str(tmpdir.join('out.nc'))
+    ncs.save(out)
+    fl = Dataset(out)
+    assert fl.variables['var'].chunking() == [3, 7]
+    assert fl.variables['var'].filters()['complevel'] == 6
+    assert fl.variables['var'].filters()['shuffle']
+    assert fl.variables['var'].endian() == 'big'
+    assert fl.variables['copy'].chunking() == [1, 7]
+    assert fl.variables['copy'].filters()['complevel'] == 2
+    assert np.allclose(fl.variables['var'][:], ncs.ifile.variables['var'][:])
+
+    ncs.change_filters('copy', zlib=False)
+    ncs.rechunk = lambda name, perem: 'contiguous' if name == 'x' else [5, 1]
+    ncs.save(out)
+    fl = Dataset(out)
+    assert fl.variables['var'].chunking() == [5, 1]
+    assert not fl.variables['copy'].filters()['zlib']
+
+def test_save_format_compression(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.format = 'NETCDF3_64BIT_OFFSET'
+    fname = str(tmpdir.join('nc3.nc'))
+    ncs.save(fname)
+    fl = Dataset(fname)
+    assert fl.data_model == 'NETCDF3_64BIT_OFFSET'
+    assert np.array_equal(fl.variables['mytemp'][:], ncs.ifile.variables['mytemp'][:])
+
+    ncs.format = 'NETCDF4'
+    ncs.compression = 'archive'
+    ncs.change_filters('T', zlib=True, complevel=2)
+    fname = str(tmpdir.join('archive.nc'))
+    ncs.save(fname)
+    fl = Dataset(fname)
+    assert fl.variables['mytemp'].filters()['complevel'] == 6
+    assert fl.variables['mytemp'].filters()['shuffle']
+    assert fl.variables['T'].filters()['complevel'] == 2
+    assert np.array_equal(fl.variables['mytemp'][:], ncs.ifile.variables['mytemp'][:])
+
+    ncs.compression = 'maximum'
+    with pytest.raises(ValueError):
+        ncs.save(fname)
+
+def test_batch(tmpdir):
+    for i in range(3):
+        fnc.ncfile(Dataset('./tests/test.nc')).save(str(tmpdir.join('in{}.nc'.format(i))))
+    tmpdir.join('in3.nc').write('not a netCDF file')
+    recipe = [('rename_dim', ('X', 'lon')), ('add_gattr', ('history', 'fixed'))]
+    done = []
+    results = fnc.batch(str(tmpdir.join('in*.nc')), recipe, outdir=str(tmpdir.join('out')),
+                        workers=2, progress=lambda *args: done.append(args[0]))
+    assert sorted(done) == [1, 2, 3, 4]
+    assert [os.path.basename(result[1]) for result in results] == ['in0.nc', 'in1.nc', 'in2.nc', 'in3.nc']
+    assert [result[2] is None for result in results] == [True, True, True, False]
+    fl = Dataset(results[0][1])
+    assert 'lon' in fl.dimensions
+    assert fl.history == 'fixed'
+    # originals are not overwritten
+    with pytest.raises(ValueError):
+        fnc.batch(str(tmpdir.join('in*.nc')), recipe, outdir=str(tmpdir), headeronly=True)
+    with pytest.raises(ValueError):
+        fnc.batch(str(tmpdir.join('in*.nc')), recipe, suffix='_fixed', formt='NETCDF4')
+    with pytest.raises(ValueError):
+        fnc.fix_file(str(tmpdir.join('in0.nc')), recipe, str(tmpdir.join('x.nc')), edits=[])
+    assert not Dataset(str(tmpdir.join('in0.nc'))).ncattrs()
+
+def test_main(tmpdir):
+    recipe = tmpdir.join('recipe.json')
+    recipe.write('[["rename_var", ["mytemp", "temp"]], ["change_dtype", ["temp", "float64"]]]')
+    assert fnc.main([str(recipe), './tests/test.nc', '-o', str(tmpdir), '-j', '1', '-q']) == 0
+    fl = Dataset(str(tmpdir.join('test.nc')))
+    assert fl.variables['temp'].dtype == np.dtype('float64')
+    results = fnc.batch(['./tests/test.nc'], [('save', ('x.nc',))], outdir=str(tmpdir), workers=1)
+    assert 'save is not an ncfile edit' in results[0][2]
+
+def test_recipe_add_var(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.add_var('z', fnc.create_variable(np.zeros(10), ('X',), attributes=OrderedDict([('a', 1), ('b', 2)])))
+    ncs.del_attr('z', 'a')
+    fname = str(tmpdir.join('recipe.json'))
+    ncs.save_recipe(fname)
+    for recipe in (fnc.load_recipe(fname), ncs.edits):
+        other = fnc.apply_recipe(fnc.ncfile(Dataset('./tests/test.nc')), recipe)
+        assert list(other.variab['z']['attributes']) == ['b']
+        assert other.variab['z'] is not ncs.variab['z']
+    other.add_attr('z', 'c', 3)
+    assert list(ncs.variab['z']['attributes']) == ['b']
+
+def test_recipe_not_stored(tmpdir):
+    fname = str(tmpdir.join('recipe.json'))
+    varname = str(tmpdir.join('var.json'))
+    fnc.dump_variable(fnc.create_variable(np.zeros(10), ('X',)), varname)
+    for data in (fnc.derived(np.hypot, 'mytemp', 'mytemp'), lambda key: np.zeros(10)[key],
+                 fnc.load_variable(varname)['data']):
+        ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+        ncs.add_var('new', fnc.create_variable(data, ('X',)))
+        with pytest.raises(ValueError):
+            ncs.save_recipe(fname)
+        assert not os.path.exists(fname)
+
+def test_recipe(tmpdir):
+    ncs = fnc.ncfile(Dataset('./tests/test.nc'))
+    ncs.rename_dim('X', 'lon')
+    ncs.rename_var('mytemp', 'temp')
+    ncs.add_attr('temp', 'scale_factor', np.float32(0.5))
+    ncs.change_dtype('temp', 'float64')
+    ncs.add_var('copy', fnc.create_variable(ncs.ifile.variables['T'], ('T',), True))
+    ncs.add_var('zeros', fnc.create_variable(np.zeros(10, dtype='int16'), ('lon',), datatype='int16'))
+    fname = str(tmpdir.join('recipe.json'))
+    ncs.save_recipe(fname)
+
+    recipe = fnc.load_recipe(fname)
+    assert [edit[0] for edit in recipe] == [edit[0] for edit in ncs.edits]
+    fl = Dataset('./tests/test.nc')
+    nc2 = fnc.apply_recipe(fnc.ncfile(fl), recipe)
+    assert list(nc2.dims.keys()) == ['lon', 'Y', 'T']
+    assert list(nc2.variab.keys()) == ['T', 'temp', 'copy', 'zeros']
+    assert nc2.variab['temp']['attributes']['scale_factor'].dtype == np.dtype('float32')
+    assert nc2.variab['temp']['datatype'] == np.dtype('float64')
+    assert nc2.variab['copy']['data'] is fl.variables['T']
+    assert nc2.variab['zeros']['data'].dtype == np.dtype('int16')
+    assert nc2.variab['zeros']['dimensions'] == ('lon',)
+